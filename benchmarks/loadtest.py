@@ -0,0 +1,223 @@
+import argparse
+import functools
+import itertools
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs, urlsplit
+
+UPDATE_MIX = [('add', 20), ('list', 15), ('last', 5), ('completed', 5), ('page', 20), ('done', 15), ('delete', 10), ('weather', 10)]
+TIMED_FUNCTIONS = ['save_data', 'generate_task_list_message', 'generate_completed_list_message', 'generate_last_tasks_message']
+
+class FakeUpstreamHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    latency = 0.0
+    message_ids = itertools.count(1)
+    calls = {}
+    calls_lock = threading.Lock()
+
+    def log_message(self, format, *args): pass
+
+    def reply(self, payload, code=200):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(code); self.send_header('Content-Type', 'application/json'); self.send_header('Content-Length', str(len(body))); self.end_headers()
+        self.wfile.write(body)
+
+    def count(self, name):
+        with self.calls_lock: self.calls[name] = self.calls.get(name, 0) + 1
+
+    def do_GET(self):
+        if self.latency: time.sleep(self.latency)
+        url = urlsplit(self.path)
+        if url.path.startswith('/gismeteo/'):
+            self.count('gismeteo')
+            return self.reply({'meta': {'status_code': 200, 'status': True},
+                               'data': {'temperature': {'air': {'C': 3.5}, 'comfort': {'C': 0.1}}, 'description': 'Облачно', 'humidity': {'percent': 70},
+                                        'pressure': {'mm_hg_atm': 755}, 'wind': {'speed': {'m_s': 4}, 'direction': {'scale_8': 2}},
+                                        'cloudiness': {'percent': 80}, 'precipitation': {'type': 0}, 'icon': {'emoji': '☁️'}}})
+        if url.path.startswith('/search'):
+            self.count('nominatim')
+            city = parse_qs(url.query).get('q', ['?'])[0]
+            return self.reply([{'lat': '43.1155', 'lon': '131.8855', 'display_name': f"{city}, Россия", 'place_id': 1}])
+        self.do_POST()
+
+    def do_POST(self):
+        if self.latency: time.sleep(self.latency)
+        length = int(self.headers.get('Content-Length') or 0)
+        if length: self.rfile.read(length)
+        url = urlsplit(self.path); method = url.path.rsplit('/', 1)[-1]
+        self.count(method)
+        if method == 'sendMessage':
+            chat_id = int(parse_qs(url.query).get('chat_id', ['0'])[0] or 0)
+            return self.reply({'ok': True, 'result': {'message_id': next(self.message_ids), 'date': 0, 'chat': {'id': chat_id, 'type': 'private'}, 'text': ''}})
+        if method == 'getMe':
+            return self.reply({'ok': True, 'result': {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}})
+        self.reply({'ok': True, 'result': True})
+
+def start_fake_upstreams(latency):
+    FakeUpstreamHandler.latency = latency
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeUpstreamHandler); server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='fake-upstreams', daemon=True).start()
+    return server
+
+def configure_environment(args, port):
+    base = f"http://127.0.0.1:{port}"
+    os.environ.update({
+        'TELEGRAM_BOT_TOKEN': '0:benchmark', 'GISMETEO_API_TOKEN': 'benchmark',
+        'TELEGRAM_API_URL': base + '/bot{0}/{1}', 'GISMETEO_API_URL': base + '/gismeteo/',
+        'NOMINATIM_DOMAIN': f"127.0.0.1:{port}", 'NOMINATIM_SCHEME': 'http',
+        'STORAGE_MODE': args.storage, 'HTTP_RETRIES': '0',
+    })
+    if not args.rate_limits: os.environ.update({'TG_GLOBAL_RATE': '1000000', 'TG_CHAT_RATE': '1000000', 'TG_GROUP_RATE': '1000000'})
+
+def write_population(users, tasks_per_user, seed):
+    rng = random.Random(seed); store = {}
+    for user in range(users):
+        tasks = [{'id': i, 'text': f"Задача {i} пользователя {user}", 'status': 'completed' if rng.random() < 0.3 else 'pending', 'added_at': 1.7e9 + i}
+                 for i in range(1, tasks_per_user + 1)]
+        store[str(100000 + user)] = {'tasks': tasks, 'next_id': tasks_per_user + 1}
+    with open('user_tasks.json', 'w', encoding='utf-8') as f: json.dump(store, f, ensure_ascii=False)
+
+def timed(samples, name, func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try: return func(*args, **kwargs)
+        finally: samples.setdefault(name, []).append(time.perf_counter() - started)
+    return wrapper
+
+def generate_stream(args, types):
+    rng = random.Random(args.seed); kinds = [kind for kind, _ in UPDATE_MIX]; weights = [weight for _, weight in UPDATE_MIX]
+    cities = ["Владивосток", "Находка", "Уссурийск", "Артём", "Хабаровск"]; update_ids = itertools.count(1)
+    for _ in range(args.updates):
+        kind = rng.choices(kinds, weights)[0]; chat_id = 100000 + rng.randrange(args.users); update_id = next(update_ids)
+        user = {'id': chat_id, 'is_bot': False, 'first_name': 'Студент'}; chat = {'id': chat_id, 'type': 'private'}
+        if kind in ('page', 'done', 'delete'):
+            data = f"list_page_{rng.randint(1, 5)}" if kind == 'page' else f"list_{kind}_{rng.randint(1, args.tasks_per_user)}_1"
+            payload = {'update_id': update_id, 'callback_query': {'id': str(update_id), 'chat_instance': 'bench', 'from': user, 'data': data,
+                                                                    'message': {'message_id': 1, 'date': 0, 'chat': chat, 'text': '.'}}}
+        else:
+            text = {'add': f"/add Новая задача {update_id}", 'list': "/list", 'last': "/last", 'completed': "/completed", 'weather': f"/weather {rng.choice(cities)}"}[kind]
+            payload = {'update_id': update_id, 'message': {'message_id': update_id, 'date': 0, 'chat': chat, 'from': user, 'text': text,
+                                                           'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]}}
+        yield kind, types.Update.de_json(payload)
+
+def percentile(values, fraction):
+    if not values: return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))]
+
+def summarize(values):
+    return {'count': len(values), 'total_ms': sum(values) * 1000, 'p50_ms': percentile(values, 0.50) * 1000,
+            'p90_ms': percentile(values, 0.90) * 1000, 'p99_ms': percentile(values, 0.99) * 1000, 'max_ms': max(values, default=0) * 1000}
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix='bot12-loadtest-'); os.chdir(workdir)
+    server = start_fake_upstreams(args.upstream_latency / 1000)
+    configure_environment(args, server.server_port)
+    write_population(args.users, args.tasks_per_user, args.seed)
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import bot12
+    from telebot import types
+    bot12.configure_telegram_api()
+    if args.storage == 'sqlite':
+        bot12.migrate_json_to_sqlite()
+    bot12.init_storage()
+    bot12.bot.threaded = False
+    function_samples = {}
+    for name in TIMED_FUNCTIONS: setattr(bot12, name, timed(function_samples, name, getattr(bot12, name)))
+    stream = list(generate_stream(args, types))
+    handler_samples = {}; samples_lock = threading.Lock(); position = itertools.count()
+
+    def client():
+        while True:
+            index = next(position)
+            if index >= len(stream): return
+            kind, update = stream[index]; started = time.perf_counter()
+            bot12.bot.process_new_updates([update])
+            elapsed = time.perf_counter() - started
+            with samples_lock: handler_samples.setdefault(kind, []).append(elapsed)
+
+    started = time.perf_counter()
+    clients = [threading.Thread(target=client, name=f'loadtest-client-{i}') for i in range(args.concurrency)]
+    for thread in clients: thread.start()
+    for thread in clients: thread.join()
+    handled = time.perf_counter() - started
+    bot12.outbox.drain(timeout=120)
+    drained = time.perf_counter() - started
+    all_samples = [value for values in handler_samples.values() for value in values]
+    return {
+        'config': {'users': args.users, 'tasks_per_user': args.tasks_per_user, 'updates': args.updates, 'concurrency': args.concurrency,
+                   'storage': args.storage, 'seed': args.seed, 'rate_limits': args.rate_limits, 'upstream_latency_ms': args.upstream_latency,
+                   'python': platform.python_version()},
+        'throughput_updates_per_s': args.updates / handled if handled else 0.0,
+        'delivered_updates_per_s': args.updates / drained if drained else 0.0,
+        'wall_s': handled, 'wall_with_outbox_drain_s': drained,
+        'handlers': dict({kind: summarize(values) for kind, values in sorted(handler_samples.items())}, all=summarize(all_samples)),
+        'functions': {name: summarize(values) for name, values in sorted(function_samples.items())},
+        'upstream_calls': dict(sorted(FakeUpstreamHandler.calls.items())),
+    }
+
+def print_report(result):
+    config = result['config']
+    print(f"\nЗагрузка: {config['users']} пользователей × {config['tasks_per_user']} задач, {config['updates']} обновлений, "
+          f"{config['concurrency']} потоков, хранилище {config['storage']}")
+    print(f"Пропускная способность: {result['throughput_updates_per_s']:.1f} обновлений/с, с доставкой исходящих: "
+          f"{result['delivered_updates_per_s']:.1f} обновлений/с ({result['wall_with_outbox_drain_s']:.2f} с)\n")
+    print(f"{'':34}{'count':>8}{'p50, мс':>10}{'p90, мс':>10}{'p99, мс':>10}{'всего, мс':>12}")
+    for section in ('handlers', 'functions'):
+        for name, stats in result[section].items():
+            print(f"{section[:1]}:{name:32}{stats['count']:>8}{stats['p50_ms']:>10.2f}{stats['p90_ms']:>10.2f}{stats['p99_ms']:>10.2f}{stats['total_ms']:>12.1f}")
+    print(f"\nВызовы заглушек: {result['upstream_calls']}")
+
+def compare(result, baseline, tolerance, min_delta_ms):
+    regressions = []
+    if baseline.get('config') != result['config']: print("Внимание: конфигурация baseline отличается, сравнение может быть некорректным.")
+    for key in ('throughput_updates_per_s', 'delivered_updates_per_s'):
+        base_throughput = baseline.get(key, 0)
+        if base_throughput and result[key] < base_throughput * (1 - tolerance):
+            regressions.append(f"{key} {base_throughput:.1f} -> {result[key]:.1f} обн/с")
+    for section in ('handlers', 'functions'):
+        for name, stats in result[section].items():
+            base = baseline.get(section, {}).get(name)
+            if base and stats['p99_ms'] > base['p99_ms'] * (1 + tolerance) and stats['p99_ms'] - base['p99_ms'] > min_delta_ms:
+                regressions.append(f"{section}.{name} p99 {base['p99_ms']:.2f} -> {stats['p99_ms']:.2f} мс")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн нагрузочный тест bot12 с локальными заглушками Telegram, Gismeteo и Nominatim.")
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--tasks-per-user', type=int, default=50)
+    parser.add_argument('--updates', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--storage', choices=['json', 'journal', 'sqlite'], default='json')
+    parser.add_argument('--seed', type=int, default=12)
+    parser.add_argument('--upstream-latency', type=float, default=0.0, help="задержка ответа заглушек, мс")
+    parser.add_argument('--rate-limits', action='store_true', help="не отключать лимиты исходящей очереди Telegram")
+    parser.add_argument('--output', help="сохранить результат в JSON")
+    parser.add_argument('--baseline', help="сравнить с сохраненным результатом")
+    parser.add_argument('--tolerance', type=float, default=0.20, help="допустимое ухудшение p99/throughput (доля)")
+    parser.add_argument('--min-delta-ms', type=float, default=1.0, help="рост p99 меньше этого порога не считается регрессией")
+    args = parser.parse_args()
+    output = os.path.abspath(args.output) if args.output else None
+    baseline = os.path.abspath(args.baseline) if args.baseline else None
+    result = run(args)
+    print_report(result)
+    if output:
+        with open(output, 'w', encoding='utf-8') as f: json.dump(result, f, indent=2, ensure_ascii=False)
+        print(f"Результат сохранен в {output}")
+    if baseline:
+        with open(baseline, 'r', encoding='utf-8') as f: regressions = compare(result, json.load(f), args.tolerance, args.min_delta_ms)
+        for regression in regressions: print(f"РЕГРЕССИЯ: {regression}")
+        if regressions: sys.exit(1)
+        print("Регрессий относительно baseline не найдено.")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+import gc
+import json
+import os
+import random
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot12
+
+TOTAL_TASKS = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+CHATS = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+SUBJECTS = ["Матанализ", "Физика", "Программирование", "История", "Английский", "Философия", "Экономика", "Базы данных"]
+ACTIONS = ["Сдать лабораторную", "Подготовиться к экзамену", "Дочитать лекцию", "Сделать ДЗ", "Написать реферат"]
+
+def build_json_store(total_tasks, chats, unique):
+    rng = random.Random(42); store = {}
+    for i in range(total_tasks):
+        user_data = store.setdefault(str(100000 + i % chats), {'tasks': [], 'next_id': 1})
+        task_id = user_data['next_id']; user_data['next_id'] += 1
+        text = f"{rng.choice(ACTIONS)} по предмету {rng.choice(SUBJECTS)}" + (f" №{rng.randint(1, 12)}" if rng.random() < 0.5 else "")
+        if unique: text += f", до {rng.randint(1, 28)}.{rng.randint(1, 12):02d}, заметка {i}"
+        user_data['tasks'].append({'id': task_id, 'text': text, 'status': 'completed' if rng.random() < 0.4 else 'pending', 'added_at': 1.7e9 + i})
+    return json.dumps(store, ensure_ascii=False)
+
+def measure(build):
+    gc.collect(); tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    gc.collect(); after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, after - before
+
+def report(title, unique):
+    payload = build_json_store(TOTAL_TASKS, CHATS, unique)
+    raw, raw_bytes = measure(lambda: json.loads(payload))
+    indexed, indexed_bytes = measure(lambda: {chat_id: bot12.TaskIndex.from_dict(user_data) for chat_id, user_data in json.loads(payload).items()})
+    lossless = all(indexed[chat_id].to_dict() == user_data for chat_id, user_data in raw.items())
+    scale = 100_000 / TOTAL_TASKS
+    print(f"\n{title}:")
+    print(f"dict-задачи (json.loads):      {raw_bytes * scale / 2**20:8.2f} МиБ на 100k задач")
+    print(f"Task + TaskIndex (__slots__):  {indexed_bytes * scale / 2**20:8.2f} МиБ на 100k задач")
+    print(f"Экономия: {100 * (1 - indexed_bytes / raw_bytes):.1f}%, конвертация без потерь: {'да' if lossless else 'НЕТ'}")
+
+def main():
+    print(f"Задач: {TOTAL_TASKS}, чатов: {CHATS}")
+    report("Уникальные тексты задач", unique=True)
+    report(f"Повторяющиеся тексты (~{len(ACTIONS) * len(SUBJECTS) * 13} вариантов, выигрыш от sys.intern)", unique=False)
+
+if __name__ == '__main__':
+    main()
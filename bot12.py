@@ -1,96 +1,990 @@
+import time
+startup_started = time.perf_counter()
 import telebot
 import json
 import os
 import sys
-import time
 import math
+import random
+import bisect
+import heapq
+import functools
+import contextvars
+import enum
+import asyncio
+import hmac
+import hashlib
+import shutil
+import queue
+import multiprocessing
+from concurrent.futures import Future
+import secrets
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import threading
+import sqlite3
+from collections import OrderedDict
 import requests
-from telebot import types
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from telebot import types, apihelper
 from telebot.util import escape
-from geopy.geocoders import Nominatim
-from geopy.exc import GeocoderTimedOut, GeocoderServiceError
 
 API_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN')
 GISMETEO_TOKEN = os.environ.get('GISMETEO_API_TOKEN')
 
-if not API_TOKEN:
-    print("Критическая ошибка: Переменная окружения TELEGRAM_BOT_TOKEN не установлена.")
-    sys.exit("Пожалуйста, установите переменную окружения TELEGRAM_BOT_TOKEN")
-if not GISMETEO_TOKEN:
-    print("Критическая ошибка: Переменная окружения GISMETEO_API_TOKEN не установлена.")
-    sys.exit("Пожалуйста, установите переменную окружения GISMETEO_API_TOKEN")
-print("Токены успешно загружены из переменных окружения.")
+GISMETEO_API_WEATHER_CURRENT = os.environ.get('GISMETEO_API_URL', 'https://api.gismeteo.net/v3/weather/current/')
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL')
+NOMINATIM_DOMAIN = os.environ.get('NOMINATIM_DOMAIN', 'nominatim.openstreetmap.org')
+NOMINATIM_SCHEME = os.environ.get('NOMINATIM_SCHEME', 'https')
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', '20'))
+HTTP_RETRIES = int(os.environ.get('HTTP_RETRIES', '3'))
+HTTP_BACKOFF = float(os.environ.get('HTTP_BACKOFF', '0.5'))
+HTTP_BACKOFF_JITTER = float(os.environ.get('HTTP_BACKOFF_JITTER', '0.5'))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', '3'))
+HTTP_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', '10'))
+BOT_RUNTIME = os.environ.get('BOT_RUNTIME', 'threaded').lower()
+ASYNC_REQUEST_LIMIT = int(os.environ.get('ASYNC_REQUEST_LIMIT', '1000'))
+BOT_INGRESS = os.environ.get('BOT_INGRESS', 'polling').lower()
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL', '')
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', '/telegram/webhook')
+WEBHOOK_HOST = os.environ.get('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', '8080'))
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET') or secrets.token_urlsafe(32)
+WEBHOOK_QUEUE_SIZE = int(os.environ.get('WEBHOOK_QUEUE_SIZE', '1000'))
+WEBHOOK_WORKERS = int(os.environ.get('WEBHOOK_WORKERS', '8'))
+WEBHOOK_DEDUP_SIZE = int(os.environ.get('WEBHOOK_DEDUP_SIZE', '10000'))
+WEBHOOK_MAX_BODY = 1024 * 1024
+TG_GLOBAL_RATE = float(os.environ.get('TG_GLOBAL_RATE', '30'))
+TG_CHAT_RATE = float(os.environ.get('TG_CHAT_RATE', '1'))
+TG_GROUP_RATE = float(os.environ.get('TG_GROUP_RATE', str(20 / 60)))
+TG_CHAT_BURST = float(os.environ.get('TG_CHAT_BURST', '3'))
+DISPATCH_WORKERS = int(os.environ.get('DISPATCH_WORKERS', '8'))
+DISPATCH_MAX_RETRIES = int(os.environ.get('DISPATCH_MAX_RETRIES', '3'))
+DISPATCH_RESULT_TIMEOUT = float(os.environ.get('DISPATCH_RESULT_TIMEOUT', '15'))
+VIEW_CACHE_SIZE = int(os.environ.get('VIEW_CACHE_SIZE', '10000'))
+BOT_SHARDS = max(1, int(os.environ.get('BOT_SHARDS', '1')))
+BOT_SHARD_ID = int(os.environ.get('BOT_SHARD_ID', '0'))
+SHARD_RING_REPLICAS = int(os.environ.get('SHARD_RING_REPLICAS', '128'))
+SHARD_QUEUE_SIZE = int(os.environ.get('SHARD_QUEUE_SIZE', '1000'))
+SHARD_LAYOUT_FILE = os.environ.get('SHARD_LAYOUT_FILE', 'shard_layout.json')
+SHARED_CACHE_FILE = os.environ.get('SHARED_CACHE_FILE', 'shared_cache.sqlite3' if BOT_SHARDS > 1 else '')
 
-GISMETEO_API_WEATHER_CURRENT = 'https://api.gismeteo.net/v3/weather/current/'
-DATA_FILE = 'user_tasks.json'
+def shard_path(path, shard=BOT_SHARD_ID):
+    if not shard: return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{shard}{ext}"
+
+DATA_FILE = shard_path('user_tasks.json')
+BOT_PROFILE_STATE_FILE = os.environ.get('BOT_PROFILE_STATE_FILE', 'bot_profile_state.json')
 TASKS_PER_PAGE = 5
 LAST_TASKS_COUNT = 10
 
+STORAGE_MODE = os.environ.get('STORAGE_MODE', 'json').lower()
+JOURNAL_FILE = shard_path(os.environ.get('JOURNAL_FILE', 'user_tasks.journal'))
+JOURNAL_COMPACT_EVERY = int(os.environ.get('JOURNAL_COMPACT_EVERY', '1000'))
+JOURNAL_COMPACT_INTERVAL = float(os.environ.get('JOURNAL_COMPACT_INTERVAL', '300'))
+JOURNAL_FSYNC = os.environ.get('JOURNAL_FSYNC', '0') == '1'
+SQLITE_FILE = shard_path(os.environ.get('SQLITE_FILE', 'user_tasks.sqlite3'))
+SQLITE_CACHE_CHATS = int(os.environ.get('SQLITE_CACHE_CHATS', '1000'))
+GEOCODE_CACHE_FILE = os.environ.get('GEOCODE_CACHE_FILE', 'geocode_cache.json')
+GEOCODE_CACHE_SIZE = int(os.environ.get('GEOCODE_CACHE_SIZE', '5000'))
+GEOCODE_CACHE_TTL = float(os.environ.get('GEOCODE_CACHE_TTL', str(30 * 24 * 3600)))
+GEOCODE_NEGATIVE_TTL = float(os.environ.get('GEOCODE_NEGATIVE_TTL', str(24 * 3600)))
+GEOCODE_SAVE_INTERVAL = float(os.environ.get('GEOCODE_SAVE_INTERVAL', '60'))
+WEATHER_CACHE_TTL = float(os.environ.get('WEATHER_CACHE_TTL', '60'))
+WEATHER_CACHE_STALE_TTL = float(os.environ.get('WEATHER_CACHE_STALE_TTL', '1800'))
+WEATHER_CACHE_ERROR_TTL = float(os.environ.get('WEATHER_CACHE_ERROR_TTL', '30'))
+WEATHER_CACHE_PRECISION = int(os.environ.get('WEATHER_CACHE_PRECISION', '2'))
+WEATHER_CACHE_SIZE = int(os.environ.get('WEATHER_CACHE_SIZE', '1000'))
+
+CHAT_LOCK_SHARDS = int(os.environ.get('CHAT_LOCK_SHARDS', '64'))
+BOT_WORKER_THREADS = int(os.environ.get('BOT_WORKER_THREADS', '2'))
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '0') == '1'
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '9100'))
+TRACE_UPDATES = os.environ.get('TRACE_UPDATES', '0') == '1'
+TRACE_SLOW_MS = float(os.environ.get('TRACE_SLOW_MS', '0'))
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+chat_locks = [threading.RLock() for _ in range(CHAT_LOCK_SHARDS)]
+user_data_lock = threading.Lock()
+save_state_lock = threading.Lock()
+save_requested = threading.Event()
+journal_lock = threading.Lock()
+journal_handle = None
+journal_records = 0
+journal_compact_event = threading.Event()
+journal_compact_lock = threading.Lock()
+journal_stop = threading.Event()
+storage = None
+all_user_data = {}
+storage_init_lock = threading.Lock()
+storage_ready = threading.Event()
+task_selections = {}
+startup_timings = {}
+startup_pending = set()
+startup_lock = threading.Lock()
+startup_reported = False
+STARTUP_PHASES = {'import': 'импорт', 'data': 'данные', 'profile': 'команды и описание'}
+current_trace = contextvars.ContextVar('current_trace', default=None)
+
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def label_key(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+def format_labels(labels):
+    if not labels: return ''
+    return '{' + ','.join(f'{key}="{escape_label_value(value)}"' for key, value in labels) + '}'
+
+class Metrics:
+    def __init__(self, enabled=METRICS_ENABLED, tracing=TRACE_UPDATES, buckets=LATENCY_BUCKETS):
+        self.enabled = enabled; self.tracing = tracing; self.buckets = buckets; self.lock = threading.Lock()
+        self.counters = {}; self.gauges = {}; self.histograms = {}; self.collectors = []
+    def inc(self, name, value=1, **labels):
+        if not self.enabled: return
+        key = (name, label_key(labels))
+        with self.lock: self.counters[key] = self.counters.get(key, 0) + value
+    def set(self, name, value, **labels):
+        if not self.enabled: return
+        with self.lock: self.gauges[(name, label_key(labels))] = value
+    def observe(self, name, seconds, **labels):
+        if self.tracing:
+            trace = current_trace.get()
+            if trace is not None: trace.append(('/'.join(str(v) for v in labels.values()) or name, seconds))
+        if not self.enabled: return
+        key = (name, label_key(labels)); bucket = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None: histogram = self.histograms[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            histogram[0][bucket] += 1; histogram[1] += seconds; histogram[2] += 1
+    def collect(self, name, kind, func):
+        self.collectors.append((name, kind, func))
+    def render(self):
+        with self.lock:
+            samples = [(name, 'counter', labels, value) for (name, labels), value in self.counters.items()]
+            samples += [(name, 'gauge', labels, value) for (name, labels), value in self.gauges.items()]
+            histograms = [(name, labels, list(h[0]), h[1], h[2]) for (name, labels), h in self.histograms.items()]
+        for name, kind, func in self.collectors:
+            try: samples += [(name, kind, label_key(labels), value) for labels, value in func()]
+            except Exception as e: print(f"Ошибка сбора метрики {name}: {e}")
+        lines = []; declared = set()
+        def declare(name, kind):
+            if name not in declared: declared.add(name); lines.append(f"# TYPE {name} {kind}")
+        for name, kind, labels, value in sorted(samples, key=lambda s: (s[0], s[2])):
+            declare(name, kind); lines.append(f"{name}{format_labels(labels)} {value}")
+        bounds = [f"{bound:g}" for bound in self.buckets] + ['+Inf']
+        for name, labels, counts, total, count in sorted(histograms, key=lambda h: (h[0], h[1])):
+            declare(name, 'histogram'); cumulative = 0
+            for bound, bucket_count in zip(bounds, counts):
+                cumulative += bucket_count; lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(labels)} {total:.6f}"); lines.append(f"{name}_count{format_labels(labels)} {count}")
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+def observe_upstream(upstream, status, started):
+    metrics.observe('bot_upstream_duration_seconds', time.perf_counter() - started, upstream=upstream, status=status)
+
+def expect_startup(*phases):
+    with startup_lock: startup_pending.update(phases)
+
+def mark_startup(phase, started):
+    elapsed = startup_timings[phase] = time.perf_counter() - started
+    metrics.set('bot_startup_seconds', elapsed, phase=phase)
+    with startup_lock:
+        finished = phase in startup_pending and startup_reported and len(startup_pending) == 1
+        startup_pending.discard(phase)
+    if finished: print(f"Фоновый запуск завершен через {(time.perf_counter() - startup_started) * 1000:.0f} мс после старта ({startup_details()}).")
+    return elapsed
+
+def startup_details():
+    return ', '.join(f"{STARTUP_PHASES.get(phase, phase)} {seconds * 1000:.0f} мс" for phase, seconds in list(startup_timings.items()))
+
+def report_startup():
+    global startup_reported
+    with startup_lock: startup_reported = True; pending = [STARTUP_PHASES.get(phase, phase) for phase in startup_pending]
+    waiting = f" В фоне: {', '.join(pending)}." if pending else ''
+    print(f"Готов к приему обновлений через {(time.perf_counter() - startup_started) * 1000:.0f} мс после старта ({startup_details()}).{waiting}")
+
+def report_error(handler, text):
+    metrics.inc('bot_handler_errors_total', handler=handler); print(text)
+
+def begin_trace():
+    if metrics.tracing and current_trace.get() is None: return current_trace.set([])
+    return None
+
+def finish_trace(name, update, started, token):
+    elapsed = time.perf_counter() - started
+    if token is not None:
+        spans = current_trace.get(); current_trace.reset(token)
+        if elapsed * 1000 >= TRACE_SLOW_MS:
+            chat = getattr(getattr(update, 'message', None) or update, 'chat', None)
+            details = ', '.join(f"{span} {seconds * 1000:.1f} мс" for span, seconds in spans)
+            print(f"Трассировка {name}: чат {chat.id if chat else '-'}, {elapsed * 1000:.1f} мс [{details}]")
+    metrics.observe('bot_handler_duration_seconds', elapsed, handler=name)
+
+def observe_handler(name):
+    def decorator(func):
+        if not (metrics.enabled or metrics.tracing): return func
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(update):
+                started = time.perf_counter(); token = begin_trace()
+                try: return await func(update)
+                except Exception: metrics.inc('bot_handler_errors_total', handler=name); raise
+                finally: finish_trace(name, update, started, token)
+            return async_wrapper
+        @functools.wraps(func)
+        def wrapper(update):
+            started = time.perf_counter(); token = begin_trace()
+            try: return func(update)
+            except Exception: metrics.inc('bot_handler_errors_total', handler=name); raise
+            finally: finish_trace(name, update, started, token)
+        return wrapper
+    return decorator
+
+class TaskStatus(enum.IntEnum):
+    PENDING = 0
+    COMPLETED = 1
+
+STATUS_NAMES = {TaskStatus.PENDING: 'pending', TaskStatus.COMPLETED: 'completed'}
+STATUS_BY_NAME = {name: status for status, name in STATUS_NAMES.items()}
+
+class Task:
+    __slots__ = ('id', 'text', 'status', 'added_at')
+    def __init__(self, task_id, text, status=TaskStatus.PENDING, added_at=None):
+        self.id = task_id; self.text = sys.intern(text) if isinstance(text, str) else text; self.status = status; self.added_at = added_at
+    @classmethod
+    def from_dict(cls, data):
+        status = data.get('status', 'pending')
+        return cls(data['id'], data.get('text'), STATUS_BY_NAME.get(status, status) if isinstance(status, str) else status, data.get('added_at'))
+    def to_dict(self):
+        data = {'id': self.id}
+        if self.text is not None: data['text'] = self.text
+        data['status'] = STATUS_NAMES.get(self.status, self.status)
+        if self.added_at is not None: data['added_at'] = self.added_at
+        return data
+    @property
+    def display_text(self): return self.text if self.text is not None else 'Нет текста'
+
+class TaskIndex:
+    def __init__(self, next_id=1):
+        self.by_id = {}; self.pending = []; self.completed = []; self.other = []; self.next_id = next_id
+    @classmethod
+    def from_dict(cls, data):
+        index = cls()
+        if not isinstance(data, dict) or 'tasks' not in data or 'next_id' not in data: return index
+        for task in data['tasks']:
+            if isinstance(task, dict) and 'id' in task: index.by_id[task['id']] = Task.from_dict(task)
+        for task_id in sorted(index.by_id): index.sequence_for(index.by_id[task_id].status).append(task_id)
+        index.next_id = max([data['next_id']] + [task_id + 1 for task_id in index.by_id])
+        return index
+    def to_dict(self): return {'tasks': [task.to_dict() for task in self.by_id.values()], 'next_id': self.next_id}
+    def __len__(self): return len(self.by_id)
+    def sequence_for(self, status):
+        if status is TaskStatus.PENDING: return self.pending
+        return self.completed if status is TaskStatus.COMPLETED else self.other
+    def add(self, task):
+        self.by_id[task.id] = task; sequence = self.sequence_for(task.status)
+        if not sequence or sequence[-1] < task.id: sequence.append(task.id)
+        else: bisect.insort(sequence, task.id)
+    def get(self, task_id): return self.by_id.get(task_id)
+    def discard_from_sequence(self, sequence, task_id):
+        position = bisect.bisect_left(sequence, task_id)
+        if position < len(sequence) and sequence[position] == task_id: del sequence[position]
+    def set_status(self, task_id, status):
+        task = self.by_id.get(task_id)
+        if task is None: return None
+        old_status = task.status; task.status = status
+        if old_status != status:
+            self.discard_from_sequence(self.sequence_for(old_status), task_id); bisect.insort(self.sequence_for(status), task_id)
+        return task
+    def remove(self, task_id):
+        task = self.by_id.pop(task_id, None)
+        if task is not None: self.discard_from_sequence(self.sequence_for(task.status), task_id)
+        return task
+    def newest(self, sequence, start, count):
+        end = len(sequence) - start
+        return [self.by_id[task_id] for task_id in reversed(sequence[max(0, end - count):max(0, end)])]
+    def list_page(self, start, count):
+        page_tasks = self.newest(self.pending, start, count)
+        if len(page_tasks) < count:
+            finished = sorted(self.completed + self.other) if self.other else self.completed
+            page_tasks += self.newest(finished, max(0, start - len(self.pending)), count - len(page_tasks))
+        return page_tasks
+    def completed_page(self, start, count): return self.newest(self.completed, start, count)
+    def last(self, count):
+        return [self.by_id[task_id] for task_id in heapq.nlargest(count, self.pending[-count:] + self.completed[-count:] + self.other[-count:])]
+
+def chat_lock(chat_id):
+    return chat_locks[int(chat_id) % CHAT_LOCK_SHARDS]
+
+def with_chat_lock(func):
+    @functools.wraps(func)
+    def wrapper(chat_id, *args, **kwargs):
+        with chat_lock(chat_id): return func(chat_id, *args, **kwargs)
+    return wrapper
+
+def snapshot_user_data(data):
+    with user_data_lock: items = list(data.items())
+    snapshot = {}
+    for chat_id_str, user_data in items:
+        if isinstance(user_data, TaskIndex):
+            with chat_lock(chat_id_str): user_data = user_data.to_dict()
+        snapshot[chat_id_str] = user_data
+    return snapshot
+
+def encode_user_data(obj):
+    if isinstance(obj, TaskIndex): return obj.to_dict()
+    raise TypeError(f"Объект {type(obj)} не сериализуется в JSON")
+
+def quarantine_data_file(reason):
+    corrupt_file = f"{DATA_FILE}.corrupt-{int(time.time())}"
+    os.replace(DATA_FILE, corrupt_file)
+    print(f"Ошибка: {reason} Файл отложен как {corrupt_file}, данные восстанавливаются без него.")
+
 def load_data():
     try:
-        if not os.path.exists(DATA_FILE): return {}
-        with open(DATA_FILE, 'r', encoding='utf-8') as f: content = f.read();
-        if not content: return {}
-        data = json.loads(content)
-        if not isinstance(data, dict): print(f"Ошибка: Ожидалась структура dict в {DATA_FILE}, найдено {type(data)}."); return {}
+        data = {}
+        if os.path.exists(DATA_FILE):
+            with open(DATA_FILE, 'r', encoding='utf-8') as f: content = f.read();
+            try: data = json.loads(content) if content else {}
+            except json.JSONDecodeError: quarantine_data_file(f"Ошибка декодирования JSON в файле {DATA_FILE}."); data = {}
+            if not isinstance(data, dict): quarantine_data_file(f"Ожидалась структура dict в {DATA_FILE}, найдено {type(data)}."); data = {}
+        if STORAGE_MODE == 'journal':
+            for path in (JOURNAL_FILE + '.old', JOURNAL_FILE): replay_journal(data, path)
         return data
-    except json.JSONDecodeError: print(f"Ошибка декодирования JSON в файле {DATA_FILE}."); return {}
-    except Exception as e: print(f"Неожиданная ошибка при загрузке данных: {e}"); return {}
+    except Exception as e:
+        print(f"Неожиданная ошибка при загрузке данных: {e}")
+        if STORAGE_MODE == 'journal': raise
+        return {}
+
+def write_snapshot(data, compact=False, path=DATA_FILE):
+    tmp_file = f"{path}.tmp"; started = time.perf_counter()
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        if compact: f.write(data if isinstance(data, str) else json.dumps(data, ensure_ascii=False, separators=(',', ':'), default=encode_user_data))
+        else: json.dump(data, f, indent=4, ensure_ascii=False, default=encode_user_data)
+        f.flush(); os.fsync(f.fileno()); size = f.tell()
+    os.replace(tmp_file, path)
+    metrics.observe('bot_snapshot_duration_seconds', time.perf_counter() - started, file=os.path.basename(path))
+    metrics.set('bot_snapshot_bytes', size, file=os.path.basename(path))
 
 def save_data(data):
+    with save_state_lock:
+        try: write_snapshot(snapshot_user_data(data))
+        except Exception as e: print(f"Ошибка сохранения данных в файл {DATA_FILE}: {e}")
+
+def json_writer():
+    while True:
+        save_requested.wait(); save_requested.clear()
+        save_data(all_user_data)
+
+def apply_journal_record(data, record):
+    op = record.get('op'); chat_id_str = str(record.get('chat'))
+    if op == 'batch':
+        for change in record['changes']: apply_journal_record(data, dict(change, chat=chat_id_str))
+        return
+    user_data = data.get(chat_id_str)
+    if not isinstance(user_data, dict) or 'tasks' not in user_data or 'next_id' not in user_data:
+        user_data = data[chat_id_str] = {'tasks': [], 'next_id': 1}
+    if op == 'add':
+        task = record['task']
+        if not any(t.get('id') == task.get('id') for t in user_data['tasks']): user_data['tasks'].append(task)
+        user_data['next_id'] = max(user_data['next_id'], record.get('next_id', task.get('id', 0) + 1))
+    elif op == 'status':
+        for task in user_data['tasks']:
+            if task.get('id') == record['id']: task['status'] = record['status']; break
+    elif op == 'delete':
+        user_data['tasks'] = [t for t in user_data['tasks'] if t.get('id') != record['id']]
+    else: print(f"Неизвестная операция в журнале: {op}")
+
+def replay_journal(data, path):
+    if not os.path.exists(path): return 0
+    applied = skipped = 0
+    with open(path, 'r', encoding='utf-8') as f:
+        for line_no, line in enumerate(f, 1):
+            if not line.strip(): continue
+            try: record = json.loads(line)
+            except json.JSONDecodeError: print(f"Поврежденная запись журнала {path}:{line_no} пропущена."); skipped += 1; continue
+            try: apply_journal_record(data, record); applied += 1
+            except Exception as e: print(f"Ошибка применения записи журнала {path}:{line_no}: {e}"); skipped += 1
+    print(f"Из журнала {path} применено записей: {applied}.")
+    if skipped:
+        corrupt_file = f"{path}.corrupt-{int(time.time())}"; shutil.copyfile(path, corrupt_file)
+        print(f"Журнал с {skipped} пропущенными записями сохранен как {corrupt_file}.")
+    return applied
+
+def open_journal():
+    global journal_handle
+    journal_handle = open(JOURNAL_FILE, 'a', encoding='utf-8')
+
+def append_journal(record):
+    global journal_records
+    line = json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n'
+    with journal_lock:
+        if journal_handle is None: open_journal()
+        journal_handle.write(line); journal_handle.flush()
+        if JOURNAL_FSYNC: os.fsync(journal_handle.fileno())
+        journal_records += 1
+        if journal_records >= JOURNAL_COMPACT_EVERY: journal_compact_event.set()
+
+def compact_journal():
+    with journal_compact_lock: rotate_and_compact_journal()
+
+def rotate_and_compact_journal():
+    global journal_records
+    old_file = JOURNAL_FILE + '.old'
+    try:
+        with journal_lock:
+            if journal_handle is not None: journal_handle.close()
+            if os.path.exists(JOURNAL_FILE):
+                if os.path.exists(old_file):
+                    with open(old_file, 'a', encoding='utf-8') as dst, open(JOURNAL_FILE, 'r', encoding='utf-8') as src: dst.write(src.read())
+                    os.remove(JOURNAL_FILE)
+                else: os.replace(JOURNAL_FILE, old_file)
+            open_journal(); journal_records = 0
+        write_snapshot(snapshot_user_data(all_user_data), compact=True)
+        if os.path.exists(old_file): os.remove(old_file)
+    except Exception as e: print(f"Ошибка компактизации журнала {JOURNAL_FILE}: {e}")
+
+def journal_compactor():
+    while not journal_stop.is_set():
+        journal_compact_event.wait(JOURNAL_COMPACT_INTERVAL); journal_compact_event.clear()
+        if journal_records and not journal_stop.is_set(): compact_journal()
+
+class JsonStorage:
+    lazy = False
+    def load(self): return load_data()
+    def load_chat(self, chat_id_str): return None
+    def start(self): threading.Thread(target=json_writer, name='json-writer', daemon=True).start()
+    def record(self, chat_id, op, **fields): save_requested.set()
+    def close(self): save_requested.clear(); save_data(all_user_data)
+
+class JournalStorage(JsonStorage):
+    compactor = None
+    def start(self):
+        compact_journal()
+        self.compactor = threading.Thread(target=journal_compactor, name='journal-compactor', daemon=True); self.compactor.start()
+        print(f"Журнальный режим хранения: {JOURNAL_FILE}, компактизация каждые {JOURNAL_COMPACT_EVERY} записей / {JOURNAL_COMPACT_INTERVAL:g} с.")
+    def record(self, chat_id, op, **fields): append_journal({'op': op, 'chat': str(chat_id), **fields})
+    def close(self):
+        journal_stop.set(); journal_compact_event.set()
+        if self.compactor is not None: self.compactor.join()
+        compact_journal()
+
+class SqliteStorage:
+    lazy = True
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS chats (chat_id INTEGER PRIMARY KEY, next_id INTEGER NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS tasks (chat_id INTEGER NOT NULL, id INTEGER NOT NULL, text TEXT NOT NULL, "
+        "status TEXT NOT NULL DEFAULT 'pending', added_at REAL, PRIMARY KEY (chat_id, id)) WITHOUT ROWID",
+        "CREATE INDEX IF NOT EXISTS tasks_chat_status ON tasks (chat_id, status, id)",
+    )
+    def __init__(self, path=SQLITE_FILE):
+        self.path = path; self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL"); self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.lock:
+            for statement in self.SCHEMA: self.conn.execute(statement)
+    def load(self): return OrderedDict()
+    def load_chat(self, chat_id_str):
+        with self.lock:
+            row = self.conn.execute("SELECT next_id FROM chats WHERE chat_id = ?", (int(chat_id_str),)).fetchone()
+            if row is None: return None
+            rows = self.conn.execute("SELECT id, text, status, added_at FROM tasks WHERE chat_id = ? ORDER BY id", (int(chat_id_str),)).fetchall()
+        return {'tasks': [{'id': r[0], 'text': r[1], 'status': r[2], 'added_at': r[3]} for r in rows], 'next_id': row[0]}
+    def start(self): print(f"SQLite режим хранения: {self.path}, в памяти до {SQLITE_CACHE_CHATS} чатов.")
+    def record(self, chat_id, op, **fields):
+        chat_id = int(chat_id)
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                if op == 'batch':
+                    for change in fields['changes']: self.apply(chat_id, change['op'], change)
+                else: self.apply(chat_id, op, fields)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK"); raise
+    def apply(self, chat_id, op, fields):
+        if op == 'add':
+            task = fields['task']
+            self.conn.execute("INSERT OR IGNORE INTO tasks (chat_id, id, text, status, added_at) VALUES (?, ?, ?, ?, ?)",
+                              (chat_id, task['id'], task['text'], task.get('status', 'pending'), task.get('added_at')))
+            self.conn.execute("INSERT INTO chats (chat_id, next_id) VALUES (?, ?) ON CONFLICT(chat_id) DO UPDATE SET next_id = max(next_id, excluded.next_id)",
+                              (chat_id, fields['next_id']))
+        elif op == 'status': self.conn.execute("UPDATE tasks SET status = ? WHERE chat_id = ? AND id = ?", (fields['status'], chat_id, fields['id']))
+        elif op == 'delete': self.conn.execute("DELETE FROM tasks WHERE chat_id = ? AND id = ?", (chat_id, fields['id']))
+        else: print(f"Неизвестная операция хранилища: {op}")
+    def load_all(self):
+        data = {}
+        with self.lock:
+            for chat_id, next_id in self.conn.execute("SELECT chat_id, next_id FROM chats"): data[str(chat_id)] = {'tasks': [], 'next_id': next_id}
+            for chat_id, task_id, text, status, added_at in self.conn.execute("SELECT chat_id, id, text, status, added_at FROM tasks ORDER BY chat_id, id"):
+                data.setdefault(str(chat_id), {'tasks': [], 'next_id': task_id + 1})['tasks'].append({'id': task_id, 'text': text, 'status': status, 'added_at': added_at})
+        return data
+    def import_chats(self, data, exact=False):
+        chats = tasks = 0
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                if exact: self.conn.execute("DELETE FROM tasks"); self.conn.execute("DELETE FROM chats")
+                for chat_id_str, user_data in data.items():
+                    if not isinstance(user_data, dict): continue
+                    user_tasks = [t for t in user_data.get('tasks', []) if isinstance(t, dict) and 'id' in t]
+                    next_id = max([user_data.get('next_id', 1)] + [t['id'] + 1 for t in user_tasks])
+                    self.conn.execute("INSERT OR REPLACE INTO chats (chat_id, next_id) VALUES (?, ?)", (int(chat_id_str), next_id))
+                    self.conn.executemany("INSERT OR REPLACE INTO tasks (chat_id, id, text, status, added_at) VALUES (?, ?, ?, ?, ?)",
+                                          [(int(chat_id_str), t['id'], t.get('text', ''), t.get('status', 'pending'), t.get('added_at')) for t in user_tasks])
+                    chats += 1; tasks += len(user_tasks)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK"); raise
+        return chats, tasks
+    def close(self):
+        with self.lock: self.conn.close()
+
+def read_json_store(json_path, journal_path):
+    data = {}
+    if os.path.exists(json_path):
+        with open(json_path, 'r', encoding='utf-8') as f: content = f.read()
+        data = json.loads(content) if content else {}
+    for path in (journal_path + '.old', journal_path): replay_journal(data, path)
+    return data
+
+def migrate_json_to_sqlite(json_path=DATA_FILE, db_path=SQLITE_FILE):
+    target = SqliteStorage(db_path)
+    try: chats, tasks = target.import_chats(read_json_store(json_path, JOURNAL_FILE))
+    finally: target.close()
+    print(f"Миграция {json_path} -> {db_path}: перенесено {chats} чатов, {tasks} задач.")
+    return chats, tasks
+
+def ring_hash(value):
+    return int.from_bytes(hashlib.blake2b(str(value).encode(), digest_size=8).digest(), 'big')
+
+class HashRing:
+    def __init__(self, shards, replicas=SHARD_RING_REPLICAS):
+        points = sorted((ring_hash(f"shard-{shard}-{replica}"), shard) for shard in range(shards) for replica in range(replicas))
+        self.shards = shards; self.hashes = [point[0] for point in points]; self.owners = [point[1] for point in points]
+    def shard_for(self, chat_id):
+        if self.shards == 1: return 0
+        return self.owners[bisect.bisect(self.hashes, ring_hash(chat_id)) % len(self.hashes)]
+
+def read_shard_layout():
     try:
-        with open(DATA_FILE, 'w', encoding='utf-8') as f: json.dump(data, f, indent=4, ensure_ascii=False)
-    except Exception as e: print(f"Ошибка сохранения данных в файл {DATA_FILE}: {e}")
+        with open(SHARD_LAYOUT_FILE, 'r', encoding='utf-8') as f: return int(json.load(f).get('shards', 1))
+    except (OSError, ValueError, AttributeError): return 1
+
+def read_shard_store(shard):
+    if STORAGE_MODE != 'sqlite': return read_json_store(shard_path(DATA_FILE, shard), shard_path(JOURNAL_FILE, shard))
+    path = shard_path(SQLITE_FILE, shard)
+    if not os.path.exists(path): return {}
+    source = SqliteStorage(path)
+    try: return source.load_all()
+    finally: source.close()
+
+def write_shard_store(shard, data, exact):
+    if STORAGE_MODE == 'sqlite':
+        target = SqliteStorage(shard_path(SQLITE_FILE, shard))
+        try: target.import_chats(data, exact=exact)
+        finally: target.close()
+        return
+    write_snapshot(data, compact=True, path=shard_path(DATA_FILE, shard))
+    for path in (shard_path(JOURNAL_FILE, shard) + '.old', shard_path(JOURNAL_FILE, shard)):
+        if os.path.exists(path): os.remove(path)
+
+def remove_shard_store(shard):
+    for path in (shard_path(DATA_FILE, shard), shard_path(JOURNAL_FILE, shard), shard_path(JOURNAL_FILE, shard) + '.old',
+                 shard_path(SQLITE_FILE, shard), shard_path(SQLITE_FILE, shard) + '-wal', shard_path(SQLITE_FILE, shard) + '-shm'):
+        if os.path.exists(path): os.remove(path)
+
+def rebalance_shards(shards=BOT_SHARDS):
+    old_shards = read_shard_layout()
+    if old_shards == shards: return 0
+    started = time.perf_counter(); ring = HashRing(shards); old_ring = HashRing(old_shards)
+    stores = {shard: read_shard_store(shard) for shard in range(old_shards)}
+    placement = {shard: {} for shard in range(shards)}; moved = 0
+    for old_shard, data in stores.items():
+        for chat_id_str, user_data in data.items():
+            owner = ring.shard_for(chat_id_str)
+            if chat_id_str in placement[owner] and old_ring.shard_for(chat_id_str) != old_shard: continue
+            placement[owner][chat_id_str] = user_data
+            if owner != old_shard: moved += 1
+    for shard in range(shards): write_shard_store(shard, {**stores.get(shard, {}), **placement[shard]}, exact=False)
+    write_snapshot({'shards': shards, 'storage': STORAGE_MODE, 'updated_at': time.time()}, compact=True, path=SHARD_LAYOUT_FILE)
+    for shard in range(shards): write_shard_store(shard, placement[shard], exact=True)
+    for shard in range(shards, old_shards): remove_shard_store(shard)
+    print(f"Перебалансировка {old_shards} -> {shards} шардов: перенесено {moved} чатов за {(time.perf_counter() - started) * 1000:.0f} мс.")
+    return moved
+
+def init_storage():
+    global storage, all_user_data
+    with storage_init_lock:
+        if storage_ready.is_set(): return storage
+        started = time.perf_counter()
+        print("Загрузка данных пользователей...")
+        new_storage = create_storage(); all_user_data = new_storage.load(); storage = new_storage
+        if BOT_SHARDS > 1 and not storage.lazy:
+            ring = HashRing(BOT_SHARDS)
+            all_user_data = {chat_id_str: user_data for chat_id_str, user_data in all_user_data.items() if ring.shard_for(chat_id_str) == BOT_SHARD_ID}
+        storage.start(); storage_ready.set()
+        elapsed = mark_startup('data', started)
+        if storage.lazy: print(f"Данные пользователей будут загружаться по запросу ({elapsed * 1000:.0f} мс).")
+        else: print(f"Данные для {len(all_user_data)} пользователей загружены за {elapsed * 1000:.0f} мс.")
+        return storage
+
+def create_storage(mode=STORAGE_MODE):
+    if mode == 'journal': return JournalStorage()
+    if mode == 'sqlite': return SqliteStorage()
+    if mode != 'json': print(f"Неизвестный STORAGE_MODE '{mode}', используется json.")
+    return JsonStorage()
 
+def record_change(chat_id, op, **fields):
+    started = time.perf_counter()
+    try: storage.record(chat_id, op, **fields)
+    except Exception as e: metrics.inc('bot_storage_errors_total', op=op); print(f"Ошибка сохранения операции {op} для чата {chat_id}: {e}")
+    metrics.observe('bot_storage_write_duration_seconds', time.perf_counter() - started, op=op)
+
+@with_chat_lock
 def get_user_data(chat_id):
-    global all_user_data
+    if not storage_ready.is_set(): init_storage()
     chat_id_str = str(chat_id)
-    if chat_id_str not in all_user_data or not isinstance(all_user_data[chat_id_str], dict) or \
-            'tasks' not in all_user_data[chat_id_str] or 'next_id' not in all_user_data[chat_id_str]:
-        all_user_data[chat_id_str] = {'tasks': [], 'next_id': 1}
-    return all_user_data[chat_id_str]
+    with user_data_lock: user_data = all_user_data.get(chat_id_str)
+    if user_data is None and storage.lazy:
+        try: user_data = storage.load_chat(chat_id_str)
+        except Exception as e: print(f"Ошибка загрузки данных чата {chat_id_str}: {e}")
+    if not isinstance(user_data, TaskIndex): user_data = TaskIndex.from_dict(user_data)
+    with user_data_lock:
+        all_user_data[chat_id_str] = user_data
+        if storage.lazy:
+            all_user_data.move_to_end(chat_id_str)
+            while len(all_user_data) > SQLITE_CACHE_CHATS: all_user_data.popitem(last=False)
+    return user_data
+
+def create_retry(idempotent=True):
+    if not idempotent:
+        return Retry(total=HTTP_RETRIES, connect=HTTP_RETRIES, read=0, status=0, other=0,
+                     backoff_factor=HTTP_BACKOFF, backoff_jitter=HTTP_BACKOFF_JITTER, raise_on_status=False)
+    return Retry(total=HTTP_RETRIES, connect=HTTP_RETRIES, read=0, status=HTTP_RETRIES,
+                 backoff_factor=HTTP_BACKOFF, backoff_jitter=HTTP_BACKOFF_JITTER, status_forcelist=(500, 502, 503, 504),
+                 allowed_methods=frozenset(['GET', 'HEAD']), respect_retry_after_header=True, raise_on_status=False)
+
+def backoff_delay(attempt):
+    return HTTP_BACKOFF * (2 ** attempt) + random.uniform(0, HTTP_BACKOFF_JITTER)
+
+def upstream_wait_timeout(connect_timeout, read_timeout):
+    return connect_timeout * (HTTP_RETRIES + 1) + read_timeout + sum(HTTP_BACKOFF * (2 ** attempt) + HTTP_BACKOFF_JITTER for attempt in range(HTTP_RETRIES)) + 1
+
+def create_http_session(retry):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+    session.mount('https://', adapter); session.mount('http://', adapter)
+    return session
+
+http_session = create_http_session(create_retry())
+telegram_session = create_http_session(create_retry(idempotent=False))
+
+def configure_telegram_api():
+    apihelper.session = telegram_session
+    if TELEGRAM_API_URL: apihelper.API_URL = TELEGRAM_API_URL
+
+def create_geocoding_adapter(proxies, ssl_context):
+    from geopy.adapters import RequestsAdapter
+    return RequestsAdapter(proxies=proxies, ssl_context=ssl_context, pool_connections=HTTP_POOL_SIZE,
+                           pool_maxsize=HTTP_POOL_SIZE, max_retries=create_retry())
+
+geolocator = None
+geolocator_lock = threading.Lock()
+
+def get_geolocator():
+    global geolocator
+    with geolocator_lock:
+        if geolocator is None:
+            from geopy.geocoders import Nominatim
+            geolocator = Nominatim(user_agent="my_telegram_task_weather_bot/1.0", domain=NOMINATIM_DOMAIN, scheme=NOMINATIM_SCHEME,
+                                   adapter_factory=create_geocoding_adapter)
+        return geolocator
+
+class TTLCache:
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize; self.ttl = ttl; self.lock = threading.Lock()
+        self.entries = OrderedDict(); self.hits = 0; self.misses = 0
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] <= time.time():
+                self.misses += 1; return None
+            self.entries.move_to_end(key); self.hits += 1
+            return entry[1]
+    def put(self, key, value, ttl=None, expires_at=None):
+        with self.lock:
+            self.entries[key] = (expires_at if expires_at is not None else time.time() + (self.ttl if ttl is None else ttl), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize: self.entries.popitem(last=False)
+    def refresh(self, key, value):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None: self.entries[key] = (entry[0], value)
+    def snapshot(self):
+        now = time.time()
+        with self.lock: return [(k, e[0], e[1]) for k, e in self.entries.items() if e[0] > now]
+
+class SharedCache:
+    SCHEMA = ("CREATE TABLE IF NOT EXISTS cache (namespace TEXT NOT NULL, key TEXT NOT NULL, expires_at REAL NOT NULL, value TEXT NOT NULL, "
+              "PRIMARY KEY (namespace, key)) WITHOUT ROWID")
+    def __init__(self, path=SHARED_CACHE_FILE):
+        self.path = path; self.lock = threading.Lock(); self.writes = 0
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5)
+        self.conn.execute("PRAGMA journal_mode=WAL"); self.conn.execute("PRAGMA synchronous=NORMAL"); self.conn.execute(self.SCHEMA)
+    def get(self, namespace, key):
+        try:
+            with self.lock: row = self.conn.execute("SELECT expires_at, value FROM cache WHERE namespace = ? AND key = ?", (namespace, key)).fetchone()
+        except sqlite3.Error as e: print(f"Ошибка чтения общего кэша {self.path}: {e}"); return None
+        if row is None or row[0] <= time.time(): return None
+        return row[0], json.loads(row[1])
+    def put(self, namespace, key, value, expires_at):
+        try:
+            with self.lock:
+                self.conn.execute("INSERT OR REPLACE INTO cache (namespace, key, expires_at, value) VALUES (?, ?, ?, ?)",
+                                  (namespace, key, expires_at, json.dumps(value, ensure_ascii=False)))
+                self.writes += 1
+                if self.writes % 1000 == 0: self.conn.execute("DELETE FROM cache WHERE expires_at <= ?", (time.time(),))
+        except sqlite3.Error as e: print(f"Ошибка записи общего кэша {self.path}: {e}")
+
+shared_cache = None
+shared_cache_lock = threading.Lock()
+
+def get_shared_cache():
+    global shared_cache
+    if not SHARED_CACHE_FILE: return None
+    with shared_cache_lock:
+        if shared_cache is None: shared_cache = SharedCache()
+        return shared_cache
+
+def normalize_city_name(city_name):
+    return ' '.join(city_name.casefold().replace('ё', 'е').split())
+
+def load_geocode_cache():
+    cache = TTLCache(GEOCODE_CACHE_SIZE, GEOCODE_CACHE_TTL)
+    try:
+        if os.path.exists(GEOCODE_CACHE_FILE):
+            with open(GEOCODE_CACHE_FILE, 'r', encoding='utf-8') as f: entries = json.load(f).get('entries', [])
+            now = time.time()
+            for key, expires_at, value in entries:
+                if expires_at > now: cache.put(key, tuple(value), expires_at=expires_at)
+            print(f"Кэш геокодинга: загружено {len(cache.entries)} записей из {GEOCODE_CACHE_FILE}.")
+    except Exception as e: print(f"Ошибка загрузки кэша геокодинга {GEOCODE_CACHE_FILE}: {e}")
+    return cache
+
+geocode_cache_save_lock = threading.Lock()
+geocode_cache_dirty = threading.Event()
+geocode_saver = None
+geocode_saver_lock = threading.Lock()
+
+def save_geocode_cache():
+    if SHARED_CACHE_FILE: return
+    try:
+        with geocode_cache_save_lock: write_snapshot({'entries': get_geocode_cache().snapshot()}, compact=True, path=GEOCODE_CACHE_FILE)
+    except Exception as e: print(f"Ошибка сохранения кэша геокодинга {GEOCODE_CACHE_FILE}: {e}")
+
+def geocode_cache_saver():
+    while True:
+        geocode_cache_dirty.wait(); time.sleep(GEOCODE_SAVE_INTERVAL)
+        geocode_cache_dirty.clear(); save_geocode_cache()
+
+def schedule_geocode_save():
+    global geocode_saver
+    if SHARED_CACHE_FILE: return
+    geocode_cache_dirty.set()
+    with geocode_saver_lock:
+        if geocode_saver is None:
+            geocode_saver = threading.Thread(target=geocode_cache_saver, name='geocode-cache-saver', daemon=True); geocode_saver.start()
+
+def flush_geocode_cache():
+    if geocode_cache_dirty.is_set(): geocode_cache_dirty.clear(); save_geocode_cache()
+
+geocode_cache = None
+geocode_cache_lock = threading.Lock()
+
+def get_geocode_cache():
+    global geocode_cache
+    with geocode_cache_lock:
+        if geocode_cache is None: geocode_cache = load_geocode_cache()
+        return geocode_cache
+
+def get_cached_coordinates(city_name):
+    cache_key = normalize_city_name(city_name)
+    cached = get_geocode_cache().get(cache_key)
+    if cached is None and get_shared_cache() is not None:
+        shared = shared_cache.get('geocode', cache_key)
+        if shared is not None: cached = tuple(shared[1]); get_geocode_cache().put(cache_key, cached, expires_at=shared[0])
+    if cached is None: return None
+    latitude, longitude, address = cached
+    if latitude is None: return None, None, f"Не удалось найти координаты для города '{escape(city_name)}'."
+    return latitude, longitude, address
+
+def remember_shared_coordinates(cache_key, value, ttl):
+    if get_shared_cache() is not None: shared_cache.put('geocode', cache_key, value, time.time() + ttl)
+
+def remember_coordinates(city_name, location):
+    cache_key = normalize_city_name(city_name)
+    if location:
+        value = (location.latitude, location.longitude, location.address)
+        get_geocode_cache().put(cache_key, value); remember_shared_coordinates(cache_key, value, GEOCODE_CACHE_TTL); schedule_geocode_save()
+        return location.latitude, location.longitude, location.address
+    get_geocode_cache().put(cache_key, (None, None, None), ttl=GEOCODE_NEGATIVE_TTL); remember_shared_coordinates(cache_key, (None, None, None), GEOCODE_NEGATIVE_TTL)
+    schedule_geocode_save()
+    return None, None, f"Не удалось найти координаты для города '{escape(city_name)}'."
+
+geocode_inflight = {}
+geocode_async_inflight = {}
+geocode_inflight_lock = threading.Lock()
 
 def get_coordinates_by_city_name(city_name):
+    cached = get_cached_coordinates(city_name)
+    if cached is not None: return cached
+    cache_key = normalize_city_name(city_name)
+    with geocode_inflight_lock:
+        call = geocode_inflight.get(cache_key); leader = call is None
+        if leader: call = geocode_inflight[cache_key] = {'event': threading.Event(), 'result': None}
+    if not leader:
+        if call['event'].wait(upstream_wait_timeout(HTTP_READ_TIMEOUT, HTTP_READ_TIMEOUT)) and call['result'] is not None: return get_cached_coordinates(city_name) or call['result']
+        return None, None, "Сервис геокодинга не ответил вовремя."
+    result = (None, None, "Внутренняя ошибка поиска координат.")
+    try: result = geocode_city_name(city_name)
+    finally:
+        call['result'] = result
+        with geocode_inflight_lock: del geocode_inflight[cache_key]
+        call['event'].set()
+    return result
+
+def geocode_city_name(city_name):
+    cached = get_cached_coordinates(city_name)
+    if cached is not None: return cached
+    from geopy.exc import GeocoderTimedOut, GeocoderServiceError
+    started = time.perf_counter()
+    try: location = get_geolocator().geocode(city_name, language='ru', timeout=HTTP_READ_TIMEOUT)
+    except GeocoderTimedOut: observe_upstream('nominatim', 'timeout', started); return None, None, "Сервис геокодинга не ответил вовремя."
+    except GeocoderServiceError as e: observe_upstream('nominatim', 'error', started); return None, None, f"Ошибка сервиса геокодинга: {e}"
+    except Exception as e:
+        observe_upstream('nominatim', 'error', started)
+        print(f"Неожиданная ошибка геокодинга '{city_name}': {e}"); return None, None, "Внутренняя ошибка поиска координат."
+    observe_upstream('nominatim', 'ok' if location else 'not_found', started)
+    return remember_coordinates(city_name, location)
+
+def parse_gismeteo_response(data):
+    meta = data.get('meta', {})
+    if meta.get('status_code') != 200 or meta.get('status') is False:
+        error_detail = f"API Gismeteo ошибка (статус {meta.get('status_code')})"
+        if 'errors' in meta and meta['errors']: error_detail += f": {meta['errors'][0].get('detail', 'Нет деталей')}"
+        print(error_detail); return None, error_detail
+    weather_data = data.get('data')
+    if not weather_data: return None, "API Gismeteo вернул пустые данные о погоде."
+    return weather_data, None
+
+def gismeteo_http_error(status_code, error_data):
+    error_message = f"Ошибка получения погоды: {status_code}"
     try:
-        geolocator = Nominatim(user_agent="my_telegram_task_weather_bot/1.0")
-        location = geolocator.geocode(city_name, language='ru', timeout=10)
-        if location:
-            print(f"Геокодинг для '{city_name}': {location.latitude}, {location.longitude} ({location.address})")
-            return location.latitude, location.longitude, location.address
-        else:
-            print(f"Геокодинг не нашел: '{city_name}'")
-            return None, None, f"Не удалось найти координаты для города '{escape(city_name)}'."
-    except GeocoderTimedOut: return None, None, "Сервис геокодинга не ответил вовремя."
-    except GeocoderServiceError as e: return None, None, f"Ошибка сервиса геокодинга: {e}"
-    except Exception as e: print(f"Неожиданная ошибка геокодинга '{city_name}': {e}"); return None, None, "Внутренняя ошибка поиска координат."
+        meta_error = error_data.get('meta', {}).get('errors', [])
+        if meta_error: error_message += f" ({meta_error[0].get('detail', 'Нет деталей')})"
+    except Exception: pass
+    return None, error_message
 
-def get_weather_by_coords(latitude, longitude):
+def fetch_weather_by_coords(latitude, longitude):
     if not GISMETEO_TOKEN: return None, "Токен API погоды не настроен."
     headers = {'X-Gismeteo-Token': GISMETEO_TOKEN, 'Accept-Encoding': 'gzip'}
     params = {'latitude': latitude, 'longitude': longitude, 'lang': 'ru'}
     url = GISMETEO_API_WEATHER_CURRENT
-    print(f"Запрос погоды: URL={url}, Params={params}")
+    started = time.perf_counter(); status = 'error'
     try:
-        response = requests.get(url, headers=headers, params=params, timeout=10)
-        print(f"Ответ API Gismeteo: Статус={response.status_code}")
+        response = http_session.get(url, headers=headers, params=params, timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+        status = response.status_code
         response.raise_for_status()
-        data = response.json(); meta = data.get('meta', {})
-        if meta.get('status_code') != 200 or meta.get('status') is False:
-            error_detail = f"API Gismeteo ошибка (статус {meta.get('status_code')})"
-            if 'errors' in meta and meta['errors']: error_detail += f": {meta['errors'][0].get('detail', 'Нет деталей')}"
-            print(error_detail); return None, error_detail
-        weather_data = data.get('data')
-        if not weather_data: return None, "API Gismeteo вернул пустые данные о погоде."
-        return weather_data, None
+        return parse_gismeteo_response(response.json())
     except requests.exceptions.HTTPError as e:
-        error_message = f"Ошибка получения погоды: {e.response.status_code}"
-        try:
-            error_data = e.response.json(); meta_error = error_data.get('meta', {}).get('errors', [])
-            if meta_error: error_message += f" ({meta_error[0].get('detail', 'Нет деталей')})"
-        except Exception: pass
-        print(f"HTTP ошибка запроса Gismeteo: {e}"); return None, error_message
+        try: error_data = e.response.json()
+        except Exception: error_data = None
+        print(f"HTTP ошибка запроса Gismeteo: {e}"); return gismeteo_http_error(e.response.status_code, error_data)
     except requests.exceptions.RequestException as e: print(f"Сетевая ошибка запроса Gismeteo: {e}"); return None, f"Сетевая ошибка: {e}"
     except Exception as e: print(f"Ошибка в get_weather_by_coords: {e}"); return None, "Внутренняя ошибка получения погоды."
+    finally: observe_upstream('gismeteo', status, started)
+
+
+class WeatherCache:
+    def __init__(self, fetch, ttl=WEATHER_CACHE_TTL, stale_ttl=WEATHER_CACHE_STALE_TTL, error_ttl=WEATHER_CACHE_ERROR_TTL, precision=WEATHER_CACHE_PRECISION, maxsize=WEATHER_CACHE_SIZE):
+        self.fetch = fetch; self.ttl = ttl; self.error_ttl = error_ttl; self.precision = precision
+        self.cache = TTLCache(maxsize, max(ttl, stale_ttl)); self.lock = threading.Lock(); self.inflight = {}; self.async_inflight = {}
+        self.hits = 0; self.misses = 0; self.coalesced = 0; self.stale = 0
+    def lookup_fresh(self, key):
+        cached = self.cache.get(key)
+        if cached is not None and cached[0] > time.time(): return cached, True
+        return cached, False
+    def get(self, latitude, longitude):
+        key = (round(latitude, self.precision), round(longitude, self.precision))
+        cached, fresh = self.lookup_fresh(key)
+        if fresh:
+            with self.lock: self.hits += 1
+            return cached[1], cached[2]
+        with self.lock:
+            cached, fresh = self.lookup_fresh(key)
+            if fresh: self.hits += 1; return cached[1], cached[2]
+            call = self.inflight.get(key); leader = call is None
+            if leader: call = self.inflight[key] = {'event': threading.Event(), 'result': None}; self.misses += 1
+            else: self.coalesced += 1
+        if not leader:
+            if call['event'].wait(upstream_wait_timeout(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)) and call['result'] is not None: return call['result']
+            return None, "Сервис погоды не ответил вовремя."
+        result = (None, "Внутренняя ошибка получения погоды.")
+        try: result = self.resolve(key, cached, *self.fetch(*key))
+        finally:
+            call['result'] = result
+            with self.lock: del self.inflight[key]
+            call['event'].set()
+        return result
+    def resolve(self, key, cached, weather_data, error_msg):
+        if error_msg is None:
+            self.cache.put(key, (time.time() + self.ttl, weather_data, None)); return weather_data, None
+        if cached is not None and cached[1] is not None:
+            with self.lock: self.stale += 1
+            print(f"Gismeteo недоступен ({error_msg}), отдаю устаревшие данные для {key}.")
+            self.cache.refresh(key, (time.time() + self.error_ttl, cached[1], None))
+            return cached[1], None
+        self.cache.put(key, (time.time() + self.error_ttl, None, error_msg), ttl=self.error_ttl)
+        return None, error_msg
+    async def get_async(self, latitude, longitude, fetch):
+        key = (round(latitude, self.precision), round(longitude, self.precision))
+        cached, fresh = self.lookup_fresh(key)
+        if fresh:
+            with self.lock: self.hits += 1
+            return cached[1], cached[2]
+        future = self.async_inflight.get(key)
+        if future is not None:
+            with self.lock: self.coalesced += 1
+            return await asyncio.shield(future)
+        future = self.async_inflight[key] = asyncio.get_running_loop().create_future()
+        with self.lock: self.misses += 1
+        result = (None, "Внутренняя ошибка получения погоды.")
+        try: result = self.resolve(key, cached, *(await fetch(*key)))
+        finally:
+            del self.async_inflight[key]; future.set_result(result)
+        return result
+    def stats(self):
+        with self.lock: return {'hits': self.hits, 'misses': self.misses, 'coalesced': self.coalesced, 'stale': self.stale, 'size': len(self.cache.entries)}
+
+def fetch_weather_shared(latitude, longitude):
+    cache = get_shared_cache(); key = f"{latitude},{longitude}"
+    if cache is not None:
+        shared = cache.get('weather', key)
+        if shared is not None: return shared[1], None
+    weather_data, error_msg = fetch_weather_by_coords(latitude, longitude)
+    if cache is not None and error_msg is None: cache.put('weather', key, weather_data, time.time() + WEATHER_CACHE_TTL)
+    return weather_data, error_msg
+
+weather_cache = WeatherCache(fetch_weather_shared)
+
+def get_weather_by_coords(latitude, longitude):
+    return weather_cache.get(latitude, longitude)
 
 def format_weather_message(weather_data, location_name):
     if not weather_data: return "Не удалось получить данные о погоде."
@@ -120,20 +1014,26 @@ def format_weather_message(weather_data, location_name):
         return message
     except Exception as e: print(f"Ошибка форматирования погоды v3: {e}"); return "Ошибка обработки данных о погоде."
 
+@with_chat_lock
 def generate_task_list_message(chat_id, page=1, context="list"):
-    user_data = get_user_data(chat_id); tasks = user_data.get('tasks', [])
-    if not tasks: return "📭 Твой список задач пуст.", None
-    sorted_tasks = sorted(tasks, key=lambda t: (t.get('status', 'pending') != 'pending', -t.get('id', 0)))
-    list_title = f"📋 *Твои задачи*"; total_tasks = len(sorted_tasks); total_pages = math.ceil(total_tasks / TASKS_PER_PAGE)
-    page = max(1, min(page, total_pages if total_pages > 0 else 1)); start_index = (page - 1) * TASKS_PER_PAGE; end_index = start_index + TASKS_PER_PAGE
-    tasks_on_page = sorted_tasks[start_index:end_index]
+    selecting = context == "select"
+    if not selecting: task_selections.pop(chat_id, None)
+    user_data = get_user_data(chat_id)
+    if not user_data: return "📭 Твой список задач пуст.", None
+    selected = {task_id for task_id in task_selections.get(chat_id, ()) if task_id in user_data.by_id} if selecting else set()
+    list_title = f"☑️ *Выбор задач* (выбрано: {len(selected)})" if selecting else f"📋 *Твои задачи*"; total_tasks = len(user_data); total_pages = math.ceil(total_tasks / TASKS_PER_PAGE)
+    page = max(1, min(page, total_pages if total_pages > 0 else 1)); start_index = (page - 1) * TASKS_PER_PAGE
+    tasks_on_page = user_data.list_page(start_index, TASKS_PER_PAGE)
     if not tasks_on_page: return f"{list_title}\n\n🤔 Задач на этой странице нет.", None
     message_text = f"{list_title} (Страница {page}/{total_pages}):\n\n"
     markup = types.InlineKeyboardMarkup(row_width=2); task_buttons = []
     for task in tasks_on_page:
-        status_icon = "⏳" if task.get('status', 'pending') == 'pending' else "✔️"; task_id = task.get('id'); task_text = escape(task.get('text', 'Нет текста'))
+        status_icon = "⏳" if task.status == TaskStatus.PENDING else "✔️"; task_id = task.id; task_text = escape(task.display_text)
         message_text += f"{status_icon} `[ID: {task_id}]` {task_text}\n"; buttons_row = []
-        if task.get('status', 'pending') == 'pending': buttons_row.append(types.InlineKeyboardButton(f"✅ Выполнить {task_id}", callback_data=f"{context}_done_{task_id}_{page}"))
+        if selecting:
+            task_buttons.append(types.InlineKeyboardButton(f"{'☑️' if task_id in selected else '⬜'} {task_id}", callback_data=f"select_toggle_{task_id}_{page}"))
+            continue
+        if task.status == TaskStatus.PENDING: buttons_row.append(types.InlineKeyboardButton(f"✅ Выполнить {task_id}", callback_data=f"{context}_done_{task_id}_{page}"))
         else: buttons_row.append(types.InlineKeyboardButton(f"↩️ Вернуть {task_id}", callback_data=f"{context}_undo_{task_id}_{page}"))
         buttons_row.append(types.InlineKeyboardButton(f"❌ Удалить {task_id}", callback_data=f"{context}_delete_{task_id}_{page}"))
         task_buttons.extend(buttons_row)
@@ -141,20 +1041,26 @@ def generate_task_list_message(chat_id, page=1, context="list"):
     if page > 1: nav_buttons.append(types.InlineKeyboardButton("⬅️ Назад", callback_data=f"{context}_page_{page - 1}"))
     if page < total_pages: nav_buttons.append(types.InlineKeyboardButton("Вперед ➡️", callback_data=f"{context}_page_{page + 1}"))
     if nav_buttons: markup.row(*nav_buttons)
+    if selecting:
+        markup.row(types.InlineKeyboardButton(f"✅ Выполнить ({len(selected)})", callback_data=f"select_done_{page}"),
+                   types.InlineKeyboardButton(f"❌ Удалить ({len(selected)})", callback_data=f"select_delete_{page}"))
+        markup.row(types.InlineKeyboardButton("✖️ Отмена", callback_data=f"select_cancel_{page}"))
+    else: markup.row(types.InlineKeyboardButton("☑️ Выбрать несколько", callback_data=f"{context}_select_{page}"))
     return message_text, markup
 
+@with_chat_lock
 def generate_completed_list_message(chat_id, page=1):
-    user_data = get_user_data(chat_id); completed_tasks = [t for t in user_data.get('tasks', []) if t.get('status') == 'completed']
-    if not completed_tasks: return "✅ У тебя пока нет выполненных задач.", None
-    sorted_tasks = sorted(completed_tasks, key=lambda t: -t.get('id', 0)); list_title = "✔️ *Выполненные задачи*"; context = "completed"
-    total_tasks = len(sorted_tasks); total_pages = math.ceil(total_tasks / TASKS_PER_PAGE)
-    page = max(1, min(page, total_pages if total_pages > 0 else 1)); start_index = (page - 1) * TASKS_PER_PAGE; end_index = start_index + TASKS_PER_PAGE
-    tasks_on_page = sorted_tasks[start_index:end_index]
+    task_selections.pop(chat_id, None); user_data = get_user_data(chat_id)
+    if not user_data.completed: return "✅ У тебя пока нет выполненных задач.", None
+    list_title = "✔️ *Выполненные задачи*"; context = "completed"
+    total_tasks = len(user_data.completed); total_pages = math.ceil(total_tasks / TASKS_PER_PAGE)
+    page = max(1, min(page, total_pages if total_pages > 0 else 1)); start_index = (page - 1) * TASKS_PER_PAGE
+    tasks_on_page = user_data.completed_page(start_index, TASKS_PER_PAGE)
     if not tasks_on_page: return f"{list_title}\n\n🤔 Выполненных задач на этой странице нет.", None
     message_text = f"{list_title} (Страница {page}/{total_pages}):\n\n"
     markup = types.InlineKeyboardMarkup(row_width=2); task_buttons = []
     for task in tasks_on_page:
-        task_id = task.get('id'); task_text = escape(task.get('text', 'Нет текста')); message_text += f"✔️ `[ID: {task_id}]` {task_text}\n"
+        task_id = task.id; task_text = escape(task.display_text); message_text += f"✔️ `[ID: {task_id}]` {task_text}\n"
         buttons_row = [types.InlineKeyboardButton(f"↩️ Вернуть {task_id}", callback_data=f"{context}_undo_{task_id}_{page}"),
                        types.InlineKeyboardButton(f"❌ Удалить {task_id}", callback_data=f"{context}_delete_{task_id}_{page}")]
         task_buttons.extend(buttons_row)
@@ -164,23 +1070,185 @@ def generate_completed_list_message(chat_id, page=1):
     if nav_buttons: markup.row(*nav_buttons)
     return message_text, markup
 
+@with_chat_lock
 def generate_last_tasks_message(chat_id):
-    user_data = get_user_data(chat_id); tasks = user_data.get('tasks', [])
-    if not tasks: return f"🕙 У тебя пока нет задач.", None
-    sorted_tasks = sorted(tasks, key=lambda t: -t.get('id', 0))[:LAST_TASKS_COUNT]
+    task_selections.pop(chat_id, None); user_data = get_user_data(chat_id)
+    if not user_data: return f"🕙 У тебя пока нет задач.", None
+    sorted_tasks = user_data.last(LAST_TASKS_COUNT)
     list_title = f"🕙 *Последние {len(sorted_tasks)} задач:*"; context = "last10"
     message_text = f"{list_title}\n\n"
     markup = types.InlineKeyboardMarkup(row_width=2); task_buttons = []
     for task in sorted_tasks:
-        status_icon = "⏳" if task.get('status', 'pending') == 'pending' else "✔️"; task_id = task.get('id'); task_text = escape(task.get('text', 'Нет текста'))
+        status_icon = "⏳" if task.status == TaskStatus.PENDING else "✔️"; task_id = task.id; task_text = escape(task.display_text)
         message_text += f"{status_icon} `[ID: {task_id}]` {task_text}\n"; buttons_row = []
-        if task.get('status', 'pending') == 'pending': buttons_row.append(types.InlineKeyboardButton(f"✅ Выполнить {task_id}", callback_data=f"{context}_done_{task_id}_0"))
+        if task.status == TaskStatus.PENDING: buttons_row.append(types.InlineKeyboardButton(f"✅ Выполнить {task_id}", callback_data=f"{context}_done_{task_id}_0"))
         else: buttons_row.append(types.InlineKeyboardButton(f"↩️ Вернуть {task_id}", callback_data=f"{context}_undo_{task_id}_0"))
         buttons_row.append(types.InlineKeyboardButton(f"❌ Удалить {task_id}", callback_data=f"{context}_delete_{task_id}_0"))
         task_buttons.extend(buttons_row)
     markup.add(*task_buttons)
     return message_text, markup
 
+ADD_TASK_PROMPT = "📝 Введите текст новой задачи:"
+CITY_PROMPT = "🌍 Введите название города:"
+TASKS_INFO_TEXT = ("📁 *Раздел 'Задачи'*\n\n"
+                   "Выбери команду:\n"
+                   "▪️ `/list`\n▪️ `/last`\n▪️ `/completed`\n▪️ `/add <текст>`")
+
+def build_welcome_text(first_name):
+    return (f"👋 *Привет, {escape(first_name)}! Я твой бот-помощник.*\n\n"
+            "Используй кнопки внизу или команду /help для справки.")
+
+def build_help_text():
+    return (
+        "📖 *Справка по командам:*\n"
+        "(Список команд также доступен через кнопку '/' или 'Меню')\n\n"
+        "🚀 `/start` - Запуск / Приветствие\n"
+        "📌 `/menu` - Показать главное меню с кнопками\n"
+        "ℹ️ `/help` - Показать эту справку\n\n"
+        "*Задачи:*\n"
+        "➕ `/add <текст>` - Добавить новую задачу (каждая строка — отдельная задача)\n"
+        "📋 `/list` - Показать все задачи\n"
+        "🕙 `/last` - Показать последние {lc} задач\n"
+        "✅ `/completed` - Показать выполненные\n\n"
+        "*Погода:*\n"
+        "☀️ `/weather <город>` - Узнать текущую погоду"
+    ).format(lc=LAST_TASKS_COUNT)
+
+def command_argument(message):
+    command_parts = message.text.split(maxsplit=1)
+    if len(command_parts) < 2 or not command_parts[1].strip(): return None
+    return command_parts[1].strip()
+
+def is_task_text_reply(message):
+    return message.reply_to_message is not None and "Введите текст новой задачи" in (message.reply_to_message.text or '')
+
+def is_city_name_reply(message):
+    return message.reply_to_message is not None and "Введите название города" in (message.reply_to_message.text or '')
+
+@with_chat_lock
+def add_task(chat_id, task_text):
+    user_data = get_user_data(chat_id)
+    current_id = user_data.next_id
+    new_task = Task(current_id, task_text, TaskStatus.PENDING, time.time())
+    user_data.add(new_task)
+    user_data.next_id += 1
+    record_change(chat_id, 'add', task=new_task.to_dict(), next_id=user_data.next_id)
+    return current_id
+
+@with_chat_lock
+def add_tasks(chat_id, task_texts):
+    user_data = get_user_data(chat_id); added_at = time.time(); changes = []
+    for task_text in task_texts:
+        new_task = Task(user_data.next_id, task_text, TaskStatus.PENDING, added_at)
+        user_data.add(new_task); user_data.next_id += 1
+        changes.append({'op': 'add', 'task': new_task.to_dict(), 'next_id': user_data.next_id})
+    record_change(chat_id, 'batch', changes=changes)
+    return [change['task']['id'] for change in changes]
+
+def add_tasks_from_text(chat_id, task_text):
+    lines = [line.strip() for line in task_text.splitlines() if line.strip()]
+    if len(lines) <= 1:
+        return f"✅ Задача добавлена! (ID: `{add_task(chat_id, task_text)}`)"
+    task_ids = add_tasks(chat_id, lines)
+    return f"✅ Добавлено задач: {len(task_ids)} (ID: `{task_ids[0]}`–`{task_ids[-1]}`)"
+
+@with_chat_lock
+def toggle_task_selection(chat_id, task_id):
+    if get_user_data(chat_id).get(task_id) is None: return None
+    selected = task_selections.setdefault(chat_id, set())
+    if task_id in selected: selected.discard(task_id)
+    else: selected.add(task_id)
+    return len(selected)
+
+@with_chat_lock
+def apply_bulk_action(chat_id, action):
+    user_data = get_user_data(chat_id); changes = []
+    for task_id in sorted(task_selections.pop(chat_id, ())):
+        task = user_data.get(task_id)
+        if task is None: continue
+        if action == "delete": user_data.remove(task_id); changes.append({'op': 'delete', 'id': task_id})
+        elif task.status == TaskStatus.PENDING: user_data.set_status(task_id, TaskStatus.COMPLETED); changes.append({'op': 'status', 'id': task_id, 'status': STATUS_NAMES[TaskStatus.COMPLETED]})
+    if changes: record_change(chat_id, 'batch', changes=changes)
+    return len(changes)
+
+@with_chat_lock
+def apply_task_action(chat_id, action, task_id):
+    user_data = get_user_data(chat_id)
+    if user_data.get(task_id) is None: return None
+    if action == "done": user_data.set_status(task_id, TaskStatus.COMPLETED); alert_text = f"✅ Задача {task_id} выполнена!"
+    elif action == "undo": user_data.set_status(task_id, TaskStatus.PENDING); alert_text = f"↩️ Задача {task_id} возвращена!"
+    else: user_data.remove(task_id); alert_text = f"🗑️ Задача {task_id} удалена!"
+    if action == "delete": record_change(chat_id, 'delete', id=task_id)
+    else: record_change(chat_id, 'status', id=task_id, status=STATUS_NAMES[user_data.get(task_id).status])
+    return alert_text
+
+def process_callback_data(chat_id, callback_data):
+    parts = callback_data.split('_')
+    if len(parts) < 2: return {'text': "Ошибка данных.", 'show_alert': True}, None
+    context = parts[0]; action = parts[1]
+    if action == "page":
+        try: current_page = int(parts[2])
+        except (ValueError, IndexError): return {'text': "Ошибка стр.", 'show_alert': True}, None
+        if context not in ("list", "completed", "select"): return {'text': "Неизвестный список."}, None
+        return {'text': f"Стр. {current_page}"}, (context, current_page)
+    if context == "list" and action == "select":
+        try: current_page = int(parts[2])
+        except (ValueError, IndexError): return {'text': "Ошибка стр.", 'show_alert': True}, None
+        with chat_lock(chat_id): task_selections.pop(chat_id, None)
+        return {'text': "Отметь задачи и выбери действие."}, ("select", current_page)
+    if context == "select":
+        try: current_page = int(parts[-1])
+        except ValueError: return {'text': "Ошибка стр.", 'show_alert': True}, None
+        if action == "toggle":
+            try: selected_count = toggle_task_selection(chat_id, int(parts[2]))
+            except (ValueError, IndexError): return {'text': "Ошибка ID/Page", 'show_alert': True}, None
+            if selected_count is None: return {'text': f"❓ Задача {parts[2]} не найдена.", 'show_alert': True}, ("select", current_page)
+            return {'text': f"Выбрано: {selected_count}"}, ("select", current_page)
+        if action in ("done", "delete"):
+            try: changed = apply_bulk_action(chat_id, action)
+            except Exception as e: print(f"Ошибка '{action}' ({context}): {e}"); return {'text': "Ошибка обработки", 'show_alert': True}, None
+            if not changed: return {'text': "Ничего не выбрано."}, ("select", current_page)
+            return {'text': f"✅ Выполнено задач: {changed}" if action == "done" else f"🗑️ Удалено задач: {changed}"}, ("list", current_page)
+        if action == "cancel":
+            with chat_lock(chat_id): task_selections.pop(chat_id, None)
+            return {'text': "Выбор отменен."}, ("list", current_page)
+        return {}, None
+    if action in ["done", "undo", "delete"]:
+        try: task_id_to_act = int(parts[2]); current_page = int(parts[3]) if len(parts) > 3 else 1
+        except (ValueError, IndexError): return {'text': "Ошибка ID/Page", 'show_alert': True}, None
+        try: alert_text = apply_task_action(chat_id, action, task_id_to_act)
+        except Exception as e: print(f"Ошибка '{action}' ({context}): {e}"); return {'text': "Ошибка обработки", 'show_alert': True}, None
+        if alert_text is None: return {'text': f"❓ Задача {task_id_to_act} не найдена.", 'show_alert': True}, (context, current_page)
+        return {'text': alert_text}, (context, current_page)
+    return {}, None
+
+def render_task_view(context, chat_id, page):
+    if context in ("list", "select"): return generate_task_list_message(chat_id, page=page, context=context)
+    if context == "completed": return generate_completed_list_message(chat_id, page=page)
+    if context == "last10": return generate_last_tasks_message(chat_id)
+    print(f"Неизвестный контекст: {context}"); return None
+
+class ViewFingerprintCache:
+    def __init__(self, maxsize=VIEW_CACHE_SIZE):
+        self.maxsize = maxsize; self.lock = threading.Lock(); self.entries = OrderedDict(); self.skipped = 0
+    @staticmethod
+    def fingerprint(message_text, markup):
+        payload = message_text + '\0' + (markup.to_json() if markup else '')
+        return hashlib.blake2b(payload.encode('utf-8'), digest_size=16).digest()
+    def is_unchanged(self, chat_id, message_id, fingerprint):
+        with self.lock:
+            if self.entries.get((chat_id, message_id)) != fingerprint: return False
+            self.entries.move_to_end((chat_id, message_id)); self.skipped += 1
+            return True
+    def remember(self, chat_id, message_id, fingerprint):
+        with self.lock:
+            self.entries[(chat_id, message_id)] = fingerprint; self.entries.move_to_end((chat_id, message_id))
+            while len(self.entries) > self.maxsize: self.entries.popitem(last=False)
+    def forget(self, chat_id, message_id):
+        with self.lock: self.entries.pop((chat_id, message_id), None)
+
+view_cache = ViewFingerprintCache()
+
 def create_main_keyboard():
     markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
     tasks_btn = types.KeyboardButton("📋 Задачи")
@@ -189,177 +1257,360 @@ def create_main_keyboard():
     markup.add(tasks_btn, weather_btn, help_btn)
     return markup
 
-bot = telebot.TeleBot(API_TOKEN)
+bot = telebot.TeleBot(API_TOKEN or '', num_threads=BOT_WORKER_THREADS, validate_token=bool(API_TOKEN))
+
+BOT_COMMANDS = [
+    ("start", "🚀 Запуск / Приветствие"),
+    ("menu", "📌 Показать главное меню"),
+    ("help", "ℹ️ Справка по командам"),
+    ("add", "➕ Добавить задачу (<текст>)"),
+    ("list", "📋 Показать все задачи"),
+    ("last", "🕙 Показать последние задачи"),
+    ("completed", "✅ Показать выполненные"),
+    ("weather", "☀️ Узнать погоду (<город>)")
+]
+BOT_DESCRIPTION = "Ваш личный помощник для управления задачами и просмотра погоды. Умеет добавлять, показывать и отмечать задачи. Запрашивает погоду по названию города."
 
 def set_bot_commands(bot_instance):
-    commands = [
-        types.BotCommand("start", "🚀 Запуск / Приветствие"),
-        types.BotCommand("menu", "📌 Показать главное меню"),
-        types.BotCommand("help", "ℹ️ Справка по командам"),
-        types.BotCommand("add", "➕ Добавить задачу (<текст>)"),
-        types.BotCommand("list", "📋 Показать все задачи"),
-        types.BotCommand("last", "🕙 Показать последние задачи"),
-        types.BotCommand("completed", "✅ Показать выполненные"),
-        types.BotCommand("weather", "☀️ Узнать погоду (<город>)")
-    ]
     try:
-        bot_instance.set_my_commands(commands)
+        bot_instance.set_my_commands([types.BotCommand(command, description) for command, description in BOT_COMMANDS])
         print("Команды бота успешно установлены.")
+        return True
     except Exception as e:
         print(f"Ошибка при установке команд бота: {e}")
+        return False
 
 def set_bot_description(bot_instance):
-    description = "Ваш личный помощник для управления задачами и просмотра погоды. Умеет добавлять, показывать и отмечать задачи. Запрашивает погоду по названию города."
     try:
-        bot_instance.set_my_description(description=description, language_code="ru")
+        bot_instance.set_my_description(description=BOT_DESCRIPTION, language_code="ru")
         print("Описание бота успешно установлено.")
+        return True
     except Exception as e:
         print(f"Ошибка при установке описания бота: {e}")
+        return False
+
+def bot_profile_hash():
+    profile = {'bot': (API_TOKEN or '').split(':')[0], 'commands': BOT_COMMANDS, 'description': BOT_DESCRIPTION}
+    return hashlib.sha256(json.dumps(profile, ensure_ascii=False, sort_keys=True).encode()).hexdigest()
+
+def sync_bot_profile(bot_instance):
+    started = time.perf_counter(); profile_hash = bot_profile_hash()
+    try:
+        with open(BOT_PROFILE_STATE_FILE, 'r', encoding='utf-8') as f: registered_hash = json.load(f).get('hash')
+    except (OSError, ValueError, AttributeError): registered_hash = None
+    if registered_hash == profile_hash:
+        print("Команды и описание бота не изменились, обновление пропущено.")
+    elif set_bot_commands(bot_instance) and set_bot_description(bot_instance):
+        try: write_snapshot({'hash': profile_hash, 'updated_at': time.time()}, compact=True, path=BOT_PROFILE_STATE_FILE)
+        except Exception as e: print(f"Ошибка сохранения {BOT_PROFILE_STATE_FILE}: {e}")
+    mark_startup('profile', started)
 
-set_bot_commands(bot)
-set_bot_description(bot)
+def check_tokens():
+    if not API_TOKEN:
+        print("Критическая ошибка: Переменная окружения TELEGRAM_BOT_TOKEN не установлена.")
+        sys.exit("Пожалуйста, установите переменную окружения TELEGRAM_BOT_TOKEN")
+    if not GISMETEO_TOKEN:
+        print("Критическая ошибка: Переменная окружения GISMETEO_API_TOKEN не установлена.")
+        sys.exit("Пожалуйста, установите переменную окружения GISMETEO_API_TOKEN")
+    print("Токены успешно загружены из переменных окружения.")
 
-print("Загрузка данных пользователей...")
-all_user_data = load_data()
-print(f"Данные для {len(all_user_data)} пользователей загружены.")
-print("Бот запускается...")
+def start_background_startup():
+    expect_startup('data', 'profile')
+    threading.Thread(target=init_storage, name='storage-loader', daemon=True).start()
+    threading.Thread(target=sync_bot_profile, args=(bot,), name='bot-profile-sync', daemon=True).start()
+
+PRIORITY_CALLBACK = 0
+PRIORITY_SEND = 1
+PRIORITY_EDIT = 2
+PRIORITY_CHAT_ACTION = 3
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate; self.capacity = capacity; self.tokens = capacity; self.updated = time.monotonic()
+    def wait_time(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate); self.updated = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+    def consume(self, now):
+        self.wait_time(now); self.tokens -= 1
+
+class OutboundJob:
+    __slots__ = ('priority', 'seq', 'chat_id', 'method', 'args', 'kwargs', 'future', 'merge_key', 'limited', 'not_before', 'attempts', 'trace')
+    def __init__(self, priority, seq, chat_id, method, args, kwargs, merge_key, limited, future):
+        self.priority = priority; self.seq = seq; self.chat_id = chat_id; self.method = method; self.args = args; self.kwargs = kwargs
+        self.future = future; self.merge_key = merge_key; self.limited = limited; self.not_before = 0; self.attempts = 0
+        self.trace = current_trace.get() if metrics.tracing else None
+
+class TelegramDispatcher:
+    def __init__(self, bot_instance, workers=DISPATCH_WORKERS, global_rate=TG_GLOBAL_RATE, chat_rate=TG_CHAT_RATE, group_rate=TG_GROUP_RATE, burst=TG_CHAT_BURST):
+        self.bot = bot_instance; self.workers = workers; self.chat_rate = chat_rate; self.group_rate = group_rate; self.burst = burst
+        self.cond = threading.Condition(); self.jobs = []; self.pending_edits = {}; self.seq = 0; self.started = False
+        self.global_bucket = TokenBucket(global_rate, global_rate); self.global_blocked_until = 0
+        self.chat_buckets = OrderedDict(); self.chat_blocked_until = {}; self.busy_chats = set()
+        self.sent = 0; self.merged = 0; self.retried = 0; self.failed = 0
+    def start(self):
+        with self.cond:
+            if self.started: return
+            self.started = True
+        for i in range(self.workers): threading.Thread(target=self.worker, name=f'tg-dispatch-{i}', daemon=True).start()
+    def submit(self, priority, chat_id, method, args, kwargs, merge_key=None, limited=True):
+        if not self.started: self.start()
+        with self.cond:
+            job = self.pending_edits.get(merge_key) if merge_key else None
+            if job is not None:
+                job.args = args; job.kwargs = kwargs; self.merged += 1
+                return job.future
+            self.seq += 1; job = OutboundJob(priority, self.seq, chat_id, method, args, kwargs, merge_key, limited, self.new_future())
+            self.jobs.append(job)
+            if merge_key: self.pending_edits[merge_key] = job
+            self.notify()
+            return job.future
+    def new_future(self): return Future()
+    def notify(self): self.cond.notify()
+    def send_message(self, chat_id, text, **kwargs):
+        return self.submit(PRIORITY_SEND, chat_id, 'send_message', (chat_id, text), kwargs)
+    def reply_to(self, message, text, **kwargs):
+        return self.submit(PRIORITY_SEND, message.chat.id, 'reply_to', (message, text), kwargs)
+    def edit_message_text(self, text, chat_id, message_id, **kwargs):
+        return self.submit(PRIORITY_EDIT, chat_id, 'edit_message_text', (), dict(kwargs, text=text, chat_id=chat_id, message_id=message_id), merge_key=(chat_id, message_id))
+    def answer_callback_query(self, callback_query_id, text=None, **kwargs):
+        return self.submit(PRIORITY_CALLBACK, None, 'answer_callback_query', (callback_query_id, text), kwargs, limited=False)
+    def send_chat_action(self, chat_id, action, **kwargs):
+        return self.submit(PRIORITY_CHAT_ACTION, chat_id, 'send_chat_action', (chat_id, action), kwargs, limited=False)
+    def chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.group_rate if chat_id < 0 else self.chat_rate, self.burst)
+            while len(self.chat_buckets) > 10000: self.chat_buckets.popitem(last=False)
+        else: self.chat_buckets.move_to_end(chat_id)
+        return bucket
+    def pick_job(self, now):
+        best = None; wait = None
+        global_wait = max(self.global_blocked_until - now, self.global_bucket.wait_time(now))
+        for job in self.jobs:
+            if job.chat_id is not None and job.chat_id in self.busy_chats: continue
+            job_wait = max(job.not_before - now, self.chat_blocked_until.get(job.chat_id, 0) - now)
+            if job.limited: job_wait = max(job_wait, global_wait, self.chat_bucket(job.chat_id).wait_time(now))
+            if job_wait <= 0:
+                if best is None or (job.priority, job.seq) < (best.priority, best.seq): best = job
+            elif wait is None or job_wait < wait: wait = job_wait
+        return best, wait
+    def take_job(self, job, now):
+        self.jobs.remove(job)
+        if job.merge_key: self.pending_edits.pop(job.merge_key, None)
+        if job.chat_id is not None: self.busy_chats.add(job.chat_id)
+        if job.limited: self.global_bucket.consume(now); self.chat_bucket(job.chat_id).consume(now)
+    def worker(self):
+        while True:
+            with self.cond:
+                while True:
+                    now = time.monotonic(); job, wait = self.pick_job(now)
+                    if job is not None: break
+                    self.cond.wait(wait)
+                self.take_job(job, now)
+            try: self.execute(job)
+            finally:
+                with self.cond:
+                    self.busy_chats.discard(job.chat_id); self.cond.notify_all()
+    def execute(self, job):
+        started = time.perf_counter(); status = 'error'
+        try:
+            result = getattr(self.bot, job.method)(*job.args, **job.kwargs); status = 'ok'
+            self.succeed(job, result)
+        except telebot.apihelper.ApiTelegramException as e: status = e.error_code; self.handle_api_error(job, e)
+        except Exception as e: self.fail(job, e)
+        finally: self.observe(job, status, started)
+    def succeed(self, job, result):
+        with self.cond: self.sent += 1
+        if not job.future.done(): job.future.set_result(result)
+    def handle_api_error(self, job, e):
+        if e.error_code == 429 and job.attempts < DISPATCH_MAX_RETRIES:
+            retry_after = (e.result_json or {}).get('parameters', {}).get('retry_after', 1)
+            print(f"Telegram 429 для чата {job.chat_id}, повтор через {retry_after} с.")
+            with self.cond:
+                until = time.monotonic() + retry_after
+                if job.chat_id is None: self.global_blocked_until = max(self.global_blocked_until, until)
+                else: self.chat_blocked_until[job.chat_id] = max(self.chat_blocked_until.get(job.chat_id, 0), until)
+                job.attempts += 1; job.not_before = until; self.retried += 1
+                if job.merge_key and job.merge_key in self.pending_edits:
+                    if not job.future.done(): job.future.set_result(None)
+                else:
+                    self.jobs.append(job)
+                    if job.merge_key: self.pending_edits[job.merge_key] = job
+            return
+        if 'message is not modified' in str(e):
+            metrics.inc('bot_telegram_not_modified_total')
+            if not job.future.done(): job.future.set_result(None)
+            return
+        self.fail(job, e)
+    def observe(self, job, status, started):
+        elapsed = time.perf_counter() - started
+        metrics.observe('bot_telegram_request_duration_seconds', elapsed, method=job.method, status=status)
+        if job.trace is not None: job.trace.append((f"telegram/{job.method}/{status}", elapsed))
+    def fail(self, job, error):
+        with self.cond: self.failed += 1
+        print(f"Ошибка отправки {job.method} (чат {job.chat_id}): {error}")
+        if not job.future.done(): job.future.set_exception(error)
+    def depth(self):
+        with self.cond: return len(self.jobs)
+    def drain(self, timeout=10):
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while (self.jobs or self.busy_chats) and time.monotonic() < deadline: self.cond.wait(0.1)
+
+outbox = TelegramDispatcher(bot)
+
+class AsyncTelegramDispatcher(TelegramDispatcher):
+    def __init__(self, bot_instance, **kwargs):
+        super().__init__(bot_instance, **kwargs); self.changed = None; self.tasks = []
+    def start(self):
+        if self.started: return
+        self.started = True; self.changed = asyncio.Event(); loop = asyncio.get_running_loop()
+        self.tasks = [loop.create_task(self.worker(), name=f'tg-dispatch-{i}') for i in range(self.workers)]
+    def new_future(self): return asyncio.get_running_loop().create_future()
+    def notify(self): self.changed.set()
+    async def worker(self):
+        while True:
+            now = time.monotonic(); job, wait = self.pick_job(now)
+            if job is None:
+                self.changed.clear()
+                try: await asyncio.wait_for(self.changed.wait(), wait)
+                except asyncio.TimeoutError: pass
+                continue
+            with self.cond: self.take_job(job, now)
+            try: await self.execute(job)
+            finally:
+                with self.cond: self.busy_chats.discard(job.chat_id)
+                self.changed.set()
+    async def execute(self, job):
+        from telebot.asyncio_helper import ApiTelegramException
+        started = time.perf_counter(); status = 'error'
+        try:
+            result = await getattr(self.bot, job.method)(*job.args, **job.kwargs); status = 'ok'
+            self.succeed(job, result)
+        except ApiTelegramException as e: status = e.error_code; self.handle_api_error(job, e)
+        except Exception as e: self.fail(job, e)
+        finally: self.observe(job, status, started)
+    async def drain(self, timeout=10):
+        deadline = time.monotonic() + timeout
+        while (self.jobs or self.busy_chats) and time.monotonic() < deadline: await asyncio.sleep(0.1)
+        for task in self.tasks: task.cancel()
+
+aoutbox = None
 
 @bot.message_handler(commands=['start', 'menu'])
+@observe_handler('start')
 def send_welcome_or_menu(message):
     if message.text.startswith('/start'):
-        welcome_text = (f"👋 *Привет, {escape(message.from_user.first_name)}! Я твой бот-помощник.*\n\n"
-                        "Используй кнопки внизу или команду /help для справки.")
-        bot.send_message(message.chat.id, welcome_text, reply_markup=create_main_keyboard(), parse_mode='Markdown')
+        outbox.send_message(message.chat.id, build_welcome_text(message.from_user.first_name), reply_markup=create_main_keyboard(), parse_mode='Markdown')
     else:
-        bot.send_message(message.chat.id, "📌 Главное меню:", reply_markup=create_main_keyboard())
+        outbox.send_message(message.chat.id, "📌 Главное меню:", reply_markup=create_main_keyboard())
 
 @bot.message_handler(commands=['help'])
+@observe_handler('help')
 def send_structured_help(message):
-    help_text = (
-        "📖 *Справка по командам:*\n"
-        "(Список команд также доступен через кнопку '/' или 'Меню')\n\n"
-        "🚀 `/start` - Запуск / Приветствие\n"
-        "📌 `/menu` - Показать главное меню с кнопками\n"
-        "ℹ️ `/help` - Показать эту справку\n\n"
-        "*Задачи:*\n"
-        "➕ `/add <текст>` - Добавить новую задачу\n"
-        "📋 `/list` - Показать все задачи\n"
-        "🕙 `/last` - Показать последние {lc} задач\n"
-        "✅ `/completed` - Показать выполненные\n\n"
-        "*Погода:*\n"
-        "☀️ `/weather <город>` - Узнать текущую погоду"
-    ).format(lc=LAST_TASKS_COUNT)
     try:
-        bot.reply_to(message, help_text, parse_mode='Markdown')
-    except Exception as e: print(f"Ошибка /help: {e}")
+        outbox.reply_to(message, build_help_text(), parse_mode='Markdown')
+    except Exception as e: report_error('help', f"Ошибка /help: {e}")
 
 @bot.message_handler(func=lambda message: message.text == "📋 Задачи")
+@observe_handler('tasks_button')
 def handle_tasks_button(message):
-    tasks_info_text = ("📁 *Раздел 'Задачи'*\n\n"
-                       "Выбери команду:\n"
-                       "▪️ `/list`\n▪️ `/last`\n▪️ `/completed`\n▪️ `/add <текст>`")
-    bot.send_message(message.chat.id, tasks_info_text, parse_mode='Markdown')
+    outbox.send_message(message.chat.id, TASKS_INFO_TEXT, parse_mode='Markdown')
 
 @bot.message_handler(func=lambda message: message.text == "☀️ Погода")
+@observe_handler('weather_button')
 def handle_weather_button(message):
-    weather_prompt_text = "🌍 Введите название города:"
-    markup = types.ForceReply(selective=True)
-    bot.send_message(message.chat.id, weather_prompt_text, reply_markup=markup)
+    outbox.send_message(message.chat.id, CITY_PROMPT, reply_markup=types.ForceReply(selective=True))
 
 @bot.message_handler(func=lambda message: message.text == "ℹ️ Помощь")
+@observe_handler('help_button')
 def handle_help_button(message):
     send_structured_help(message)
 
 @bot.message_handler(commands=['add'])
+@observe_handler('add')
 def handle_add_task(message):
-    global all_user_data
     try:
-        user_data = get_user_data(message.chat.id)
-        command_parts = message.text.split(maxsplit=1)
-        if len(command_parts) < 2 or not command_parts[1].strip():
-            prompt_text = "📝 Введите текст новой задачи:"
-            markup = types.ForceReply(selective=True)
-            bot.reply_to(message, prompt_text, reply_markup=markup)
+        task_text = command_argument(message)
+        if task_text is None:
+            outbox.reply_to(message, ADD_TASK_PROMPT, reply_markup=types.ForceReply(selective=True))
             return
-        task_text = command_parts[1].strip()
-        current_id = user_data['next_id']
-        new_task = {'id': current_id, 'text': task_text, 'status': 'pending', 'added_at': time.time()}
-        user_data['tasks'].append(new_task)
-        user_data['next_id'] += 1
-        save_data(all_user_data)
-        bot.reply_to(message, f"✅ Задача добавлена! (ID: `{current_id}`)", parse_mode='Markdown')
+        outbox.reply_to(message, add_tasks_from_text(message.chat.id, task_text), parse_mode='Markdown')
     except Exception as e:
-        print(f"Ошибка /add: {e}")
-        bot.reply_to(message, "❌ Ошибка при добавлении задачи.")
+        report_error('add', f"Ошибка /add: {e}")
+        outbox.reply_to(message, "❌ Ошибка при добавлении задачи.")
 
 @bot.message_handler(commands=['list'])
+@observe_handler('list')
 def handle_list_tasks(message):
     try:
         chat_id = message.chat.id; message_text, markup = generate_task_list_message(chat_id, page=1, context="list")
-        bot.send_message(chat_id, message_text, reply_markup=markup, parse_mode='Markdown')
-    except Exception as e: print(f"Ошибка /list: {e}"); bot.reply_to(message, "❌ Не удалось показать список.")
+        send_task_view(chat_id, message_text, markup)
+    except Exception as e: report_error('list', f"Ошибка /list: {e}"); outbox.reply_to(message, "❌ Не удалось показать список.")
 
 @bot.message_handler(commands=['last', 'last10'])
+@observe_handler('last')
 def handle_last_tasks(message):
     try:
         chat_id = message.chat.id; message_text, markup = generate_last_tasks_message(chat_id)
-        bot.send_message(chat_id, message_text, reply_markup=markup, parse_mode='Markdown')
-    except Exception as e: print(f"Ошибка /last: {e}"); bot.reply_to(message, "❌ Не удалось показать последние задачи.")
+        send_task_view(chat_id, message_text, markup)
+    except Exception as e: report_error('last', f"Ошибка /last: {e}"); outbox.reply_to(message, "❌ Не удалось показать последние задачи.")
 
 @bot.message_handler(commands=['completed'])
+@observe_handler('completed')
 def handle_completed_tasks(message):
     try:
         chat_id = message.chat.id; message_text, markup = generate_completed_list_message(chat_id, page=1)
-        bot.send_message(chat_id, message_text, reply_markup=markup, parse_mode='Markdown')
-    except Exception as e: print(f"Ошибка /completed: {e}"); bot.reply_to(message, "❌ Не удалось показать выполненные задачи.")
+        send_task_view(chat_id, message_text, markup)
+    except Exception as e: report_error('completed', f"Ошибка /completed: {e}"); outbox.reply_to(message, "❌ Не удалось показать выполненные задачи.")
 
 @bot.message_handler(commands=['weather'])
+@observe_handler('weather')
 def handle_weather_command(message):
     try:
-        command_parts = message.text.split(maxsplit=1)
-        if len(command_parts) < 2 or not command_parts[1].strip():
-            prompt_text = "🌍 Введите название города:"
-            markup = types.ForceReply(selective=True)
-            bot.reply_to(message, prompt_text, reply_markup=markup)
+        city_name_query = command_argument(message)
+        if city_name_query is None:
+            outbox.reply_to(message, CITY_PROMPT, reply_markup=types.ForceReply(selective=True))
             return
-        city_name_query = command_parts[1].strip()
-        processing_msg = bot.reply_to(message, f"🌍 Ищу '{escape(city_name_query)}'...")
+        processing_msg = outbox.reply_to(message, f"🌍 Ищу '{escape(city_name_query)}'...").result(timeout=DISPATCH_RESULT_TIMEOUT)
         latitude, longitude, full_address = get_coordinates_by_city_name(city_name_query)
         if full_address and not latitude:
-            bot.edit_message_text(chat_id=message.chat.id, message_id=processing_msg.message_id, text=f"⚠️ {full_address}")
+            outbox.edit_message_text(chat_id=message.chat.id, message_id=processing_msg.message_id, text=f"⚠️ {full_address}")
             return
         location_display_name = full_address if full_address else city_name_query
-        bot.edit_message_text(chat_id=message.chat.id, message_id=processing_msg.message_id, text=f"📍 Найдены координаты. Запрашиваю погоду...")
-        bot.send_chat_action(message.chat.id, 'typing')
+        outbox.edit_message_text(chat_id=message.chat.id, message_id=processing_msg.message_id, text=f"📍 Найдены координаты. Запрашиваю погоду...")
+        outbox.send_chat_action(message.chat.id, 'typing')
         weather_data, error_msg = get_weather_by_coords(latitude, longitude)
         if error_msg:
-            bot.edit_message_text(chat_id=message.chat.id, message_id=processing_msg.message_id, text=f"⚠️ Ошибка погоды: {error_msg}")
+            outbox.edit_message_text(chat_id=message.chat.id, message_id=processing_msg.message_id, text=f"⚠️ Ошибка погоды: {error_msg}")
             return
         weather_message = format_weather_message(weather_data, location_display_name)
-        bot.edit_message_text(chat_id=message.chat.id, message_id=processing_msg.message_id, text=weather_message, parse_mode='Markdown')
+        outbox.edit_message_text(chat_id=message.chat.id, message_id=processing_msg.message_id, text=weather_message, parse_mode='Markdown')
     except Exception as e:
-        print(f"Критич. ошибка handle_weather_command: {e}")
+        report_error('weather', f"Критич. ошибка handle_weather_command: {e}")
         try:
-            if 'processing_msg' in locals() and processing_msg: bot.edit_message_text(chat_id=message.chat.id, message_id=processing_msg.message_id, text="❌ Внутр. ошибка погоды.")
-            else: bot.reply_to(message, "❌ Внутр. ошибка погоды.")
-        except Exception as inner_e: print(f"Не удалось отправить сообщение об ошибке погоды: {inner_e}"); bot.send_message(message.chat.id, "❌ Внутр. ошибка погоды.")
+            if 'processing_msg' in locals() and processing_msg: outbox.edit_message_text(chat_id=message.chat.id, message_id=processing_msg.message_id, text="❌ Внутр. ошибка погоды.")
+            else: outbox.reply_to(message, "❌ Внутр. ошибка погоды.")
+        except Exception as inner_e: print(f"Не удалось отправить сообщение об ошибке погоды: {inner_e}"); outbox.send_message(message.chat.id, "❌ Внутр. ошибка погоды.")
 
-@bot.message_handler(func=lambda message: message.reply_to_message is not None and "Введите текст новой задачи" in message.reply_to_message.text)
+@bot.message_handler(func=is_task_text_reply)
+@observe_handler('task_reply')
 def handle_task_text_reply(message):
     task_text = message.text.strip()
     if not task_text:
-        bot.reply_to(message, "Вы отправили пустой текст. Задача не добавлена. Попробуйте /add <текст>.")
+        outbox.reply_to(message, "Вы отправили пустой текст. Задача не добавлена. Попробуйте /add <текст>.")
         return
     print(f"Получен ответ на запрос текста задачи: '{task_text}'")
     fake_command_message = message
     fake_command_message.text = f"/add {task_text}"
     handle_add_task(fake_command_message)
 
-@bot.message_handler(func=lambda message: message.reply_to_message is not None and "Введите название города" in message.reply_to_message.text)
+@bot.message_handler(func=is_city_name_reply)
+@observe_handler('city_reply')
 def handle_city_name_reply(message):
     city_name = message.text.strip()
     if not city_name:
-        bot.reply_to(message, "Вы отправили пустое название. Попробуйте /weather <город>.")
+        outbox.reply_to(message, "Вы отправили пустое название. Попробуйте /weather <город>.")
         return
     print(f"Получен ответ на запрос города: '{city_name}'")
     fake_command_message = message
@@ -367,64 +1618,470 @@ def handle_city_name_reply(message):
     handle_weather_command(fake_command_message)
 
 @bot.callback_query_handler(func=lambda call: True)
+@observe_handler('callback')
 def handle_callback_query(call):
-    global all_user_data; chat_id = call.message.chat.id; message_id = call.message.message_id; callback_data = call.data
+    chat_id = call.message.chat.id; message_id = call.message.message_id; callback_data = call.data
     try:
-        parts = callback_data.split('_');
-        if len(parts) < 2: bot.answer_callback_query(call.id, "Ошибка данных.", show_alert=True); return
-        context = parts[0]; action = parts[1]
-        if action == "page":
-            try:
-                current_page = int(parts[2])
-                if context == "list": message_text, markup = generate_task_list_message(chat_id, page=current_page, context=context)
-                elif context == "completed": message_text, markup = generate_completed_list_message(chat_id, page=current_page)
-                else: bot.answer_callback_query(call.id, "Неизвестный список."); return
-                bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=message_text, reply_markup=markup, parse_mode='Markdown')
-                bot.answer_callback_query(call.id, text=f"Стр. {current_page}")
-            except (ValueError, IndexError): bot.answer_callback_query(call.id, "Ошибка стр.", show_alert=True)
-            except Exception as e: print(f"Ошибка пагинации ({context}): {e}"); bot.answer_callback_query(call.id, "Ошибка обновления", show_alert=True)
-        elif action in ["done", "undo", "delete"]:
-            try:
-                task_id_to_act = int(parts[2]); current_page = int(parts[3]) if len(parts) > 3 else 1
-                user_data = get_user_data(chat_id); task_found = False; task_index = -1
-                for i, task in enumerate(user_data.get('tasks', [])):
-                    if task.get('id') == task_id_to_act: task_found = True; task_index = i; break
-                if not task_found: bot.answer_callback_query(call.id, f"❓ Задача {task_id_to_act} не найдена.", show_alert=True); update_task_view(context, chat_id, message_id, current_page); return
-                alert_text = ""
-                if action == "done": user_data['tasks'][task_index]['status'] = 'completed'; alert_text = f"✅ Задача {task_id_to_act} выполнена!"
-                elif action == "undo": user_data['tasks'][task_index]['status'] = 'pending'; alert_text = f"↩️ Задача {task_id_to_act} возвращена!"
-                elif action == "delete": del user_data['tasks'][task_index]; alert_text = f"🗑️ Задача {task_id_to_act} удалена!"
-                save_data(all_user_data); bot.answer_callback_query(call.id, text=alert_text)
-                update_task_view(context, chat_id, message_id, current_page)
-            except (ValueError, IndexError): bot.answer_callback_query(call.id, "Ошибка ID/Page", show_alert=True)
-            except Exception as e: print(f"Ошибка '{action}' ({context}): {e}"); bot.answer_callback_query(call.id, "Ошибка обработки", show_alert=True)
-        else: bot.answer_callback_query(call.id)
+        answer, view = process_callback_data(chat_id, callback_data)
+        outbox.answer_callback_query(call.id, **answer)
+        if view: update_task_view(view[0], chat_id, message_id, view[1])
     except Exception as e:
-        print(f"Критич. ошибка callback: {e}, data: {callback_data}")
-        try: bot.answer_callback_query(call.id, "Внутр. ошибка", show_alert=True)
+        report_error('callback', f"Критич. ошибка callback: {e}, data: {callback_data}")
+        try: outbox.answer_callback_query(call.id, "Внутр. ошибка", show_alert=True)
         except Exception: pass
 
 def update_task_view(context, chat_id, message_id, page):
     try:
-        if context == "list": message_text, markup = generate_task_list_message(chat_id, page=page, context=context)
-        elif context == "completed": message_text, markup = generate_completed_list_message(chat_id, page=page)
-        elif context == "last10": message_text, markup = generate_last_tasks_message(chat_id)
-        else: print(f"Неизвестный контекст: {context}"); return
-        bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=message_text, reply_markup=markup, parse_mode='Markdown')
-    except telebot.apihelper.ApiTelegramException as e:
-        if 'message is not modified' in str(e): print(f"Сообщение {message_id} не изменено.")
-        elif 'Too Many Requests' in str(e): print(f"Слишком много запросов {message_id}."); time.sleep(1)
-        else: print(f"Ошибка API при обновлении ({context}): {e}")
+        rendered = render_task_view(context, chat_id, page)
+        if rendered is None: return
+        message_text, markup = rendered
+        fingerprint = view_cache.fingerprint(message_text, markup)
+        if view_cache.is_unchanged(chat_id, message_id, fingerprint): return
+        view_cache.remember(chat_id, message_id, fingerprint)
+        future = outbox.edit_message_text(chat_id=chat_id, message_id=message_id, text=message_text, reply_markup=markup, parse_mode='Markdown')
+        future.add_done_callback(lambda f: f.exception() is not None and view_cache.forget(chat_id, message_id))
     except Exception as e: print(f"Ошибка обновления ({context}): {e}")
 
-if __name__ == '__main__':
+def send_task_view(chat_id, message_text, markup):
+    future = outbox.send_message(chat_id, message_text, reply_markup=markup, parse_mode='Markdown')
+    fingerprint = view_cache.fingerprint(message_text, markup)
+    future.add_done_callback(lambda f: f.exception() is None and f.result() is not None and view_cache.remember(chat_id, f.result().message_id, fingerprint))
+    return future
+
+class UpdateDeduplicator:
+    def __init__(self, maxsize=WEBHOOK_DEDUP_SIZE):
+        self.maxsize = maxsize; self.lock = threading.Lock(); self.seen = OrderedDict(); self.duplicates = 0
+    def claim(self, update_id):
+        with self.lock:
+            if update_id in self.seen: self.duplicates += 1; return False
+            self.seen[update_id] = True
+            while len(self.seen) > self.maxsize: self.seen.popitem(last=False)
+            return True
+    def forget(self, update_id):
+        with self.lock: self.seen.pop(update_id, None)
+
+webhook_queue = queue.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+webhook_dedup = UpdateDeduplicator()
+
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args): pass
+    def reply(self, code, body=b''):
+        self.send_response(code); self.send_header('Content-Length', str(len(body))); self.end_headers()
+        if body: self.wfile.write(body)
+    def do_GET(self):
+        if self.path == '/healthz': self.reply(200, f"ok queue={webhook_queue.qsize()}".encode())
+        else: self.reply(404)
+    def do_POST(self):
+        if self.path != WEBHOOK_PATH: return self.reply(404)
+        if not hmac.compare_digest(self.headers.get('X-Telegram-Bot-Api-Secret-Token', '').encode(), WEBHOOK_SECRET.encode()): return self.reply(403)
+        try: length = int(self.headers.get('Content-Length') or 0)
+        except ValueError: return self.reply(400)
+        if length <= 0: return self.reply(400)
+        if length > WEBHOOK_MAX_BODY: return self.reply(413)
+        try:
+            update_json = json.loads(self.rfile.read(length)); update_id = update_json['update_id']
+        except Exception: return self.reply(400)
+        if not isinstance(update_id, int) or isinstance(update_id, bool): return self.reply(400)
+        if not webhook_dedup.claim(update_id): return self.reply(200)
+        try: webhook_queue.put_nowait(update_json)
+        except queue.Full:
+            webhook_dedup.forget(update_id)
+            print(f"Очередь webhook переполнена, update {update_id} будет доставлен повторно."); return self.reply(503)
+        self.reply(200)
+
+def webhook_worker():
+    while True:
+        update_json = webhook_queue.get()
+        try: bot.process_new_updates([types.Update.de_json(update_json)])
+        except Exception as e: print(f"Ошибка обработки update {update_json.get('update_id')}: {e}")
+        finally: webhook_queue.task_done()
+
+def run_webhook():
+    if not WEBHOOK_URL: raise ValueError("WEBHOOK_URL не задан")
+    bot.threaded = False
+    for i in range(WEBHOOK_WORKERS): threading.Thread(target=webhook_worker, name=f'webhook-worker-{i}', daemon=True).start()
+    server = ThreadingHTTPServer((WEBHOOK_HOST, WEBHOOK_PORT), WebhookRequestHandler)
+    server.daemon_threads = True
+    bot.set_webhook(url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET, max_connections=min(100, WEBHOOK_QUEUE_SIZE))
+    print(f"Webhook слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}, {WEBHOOK_WORKERS} обработчиков, очередь {WEBHOOK_QUEUE_SIZE}.")
+    report_startup()
+    try: server.serve_forever()
+    finally: server.server_close()
+
+def run_polling():
     print("Запуск polling...")
+    try: bot.remove_webhook()
+    except Exception as e: print(f"Не удалось снять webhook: {e}")
+    report_startup()
+    bot.infinity_polling(timeout=20, long_polling_timeout=10)
+
+def update_chat_id(update):
+    for name in ('message', 'edited_message', 'channel_post', 'edited_channel_post', 'my_chat_member', 'chat_member'):
+        item = getattr(update, name, None)
+        if item is not None: return item.chat.id
+    call = update.callback_query
+    if call is not None: return call.message.chat.id if call.message is not None else call.from_user.id
+    return 0
+
+def shard_consumer(update_queue):
+    while True:
+        update = update_queue.get()
+        if update is None: update_queue.put(None); return
+        try: bot.process_new_updates([update])
+        except Exception as e: print(f"Ошибка обработки update {update.update_id} в шарде {BOT_SHARD_ID}: {e}")
+
+def run_shard_worker(shard, update_queue):
+    bot.threaded = False
+    configure_telegram_api(); start_metrics_server(); init_storage()
+    consumers = [threading.Thread(target=shard_consumer, args=(update_queue,), name=f'shard-consumer-{i}', daemon=True) for i in range(BOT_WORKER_THREADS)]
+    for consumer in consumers: consumer.start()
+    print(f"Шард {shard} (pid {os.getpid()}) принимает обновления.")
+    try:
+        for consumer in consumers: consumer.join()
+    except KeyboardInterrupt: pass
+    finally:
+        outbox.drain()
+        if storage_ready.is_set(): storage.close()
+
+class ShardRouter:
+    def __init__(self, shards=BOT_SHARDS):
+        self.ring = HashRing(shards); self.context = multiprocessing.get_context('spawn'); self.stopping = False
+        self.queues = [self.context.Queue(SHARD_QUEUE_SIZE) for _ in range(shards)]; self.processes = [None] * shards
+    def spawn(self, shard):
+        overrides = {'BOT_SHARD_ID': str(shard), 'TG_GLOBAL_RATE': str(TG_GLOBAL_RATE / len(self.queues)), 'METRICS_PORT': str(METRICS_PORT + 1 + shard)}
+        saved = {key: os.environ.get(key) for key in overrides}
+        os.environ.update(overrides)
+        try:
+            process = self.context.Process(target=run_shard_worker, args=(shard, self.queues[shard]), name=f'bot-shard-{shard}')
+            process.start()
+        finally:
+            for key, value in saved.items():
+                if value is None: os.environ.pop(key, None)
+                else: os.environ[key] = value
+        self.processes[shard] = process
+    def start(self):
+        for shard in range(len(self.queues)): self.spawn(shard)
+        threading.Thread(target=self.supervise, name='shard-supervisor', daemon=True).start()
+    def supervise(self):
+        while not self.stopping:
+            time.sleep(5)
+            for shard, process in enumerate(self.processes):
+                if not self.stopping and not process.is_alive():
+                    print(f"Шард {shard} завершился (код {process.exitcode}), перезапуск..."); self.spawn(shard)
+    def route(self, updates):
+        for update in updates:
+            shard = self.ring.shard_for(update_chat_id(update))
+            self.queues[shard].put(update)
+            metrics.inc('bot_routed_updates_total', shard=shard)
+    def depths(self):
+        return [({'shard': shard}, update_queue.qsize()) for shard, update_queue in enumerate(self.queues)]
+    def stop(self, timeout=30):
+        self.stopping = True
+        for update_queue in self.queues: update_queue.put(None)
+        for process in self.processes: process.join(timeout)
+
+def start_shard_router():
+    if BOT_RUNTIME == 'asyncio': print("BOT_SHARDS > 1: шарды работают в потоковом режиме, BOT_RUNTIME=asyncio игнорируется.")
+    router = ShardRouter(); router.start()
+    bot.process_new_updates = router.route
+    metrics.collect('bot_shard_queue_depth', 'gauge', router.depths)
+    expect_startup('profile')
+    threading.Thread(target=sync_bot_profile, args=(bot,), name='bot-profile-sync', daemon=True).start()
+    print(f"Обновления распределяются по {BOT_SHARDS} шардам (процессам).")
+    return router
+
+def register_metric_collectors():
+    metrics.collect('bot_outbox_queue_depth', 'gauge', lambda: [({}, (aoutbox or outbox).depth())])
+    metrics.collect('bot_outbox_jobs_total', 'counter', lambda: [({'result': name}, getattr(aoutbox or outbox, name)) for name in ('sent', 'merged', 'retried', 'failed')])
+    metrics.collect('bot_webhook_queue_depth', 'gauge', lambda: [({}, webhook_queue.qsize())])
+    metrics.collect('bot_webhook_duplicates_total', 'counter', lambda: [({}, webhook_dedup.duplicates)])
+    metrics.collect('bot_journal_pending_records', 'gauge', lambda: [({}, journal_records)])
+    metrics.collect('bot_chats_in_memory', 'gauge', lambda: [({}, len(all_user_data))])
+    metrics.collect('bot_weather_cache_events_total', 'counter', lambda: [({'event': name}, value) for name, value in weather_cache.stats().items() if name != 'size'])
+    metrics.collect('bot_weather_cache_entries', 'gauge', lambda: [({}, len(weather_cache.cache.entries))])
+    metrics.collect('bot_geocode_cache_events_total', 'counter', lambda: [({'event': 'hit'}, get_geocode_cache().hits), ({'event': 'miss'}, get_geocode_cache().misses)])
+    metrics.collect('bot_geocode_cache_entries', 'gauge', lambda: [({}, len(get_geocode_cache().entries))])
+    metrics.collect('bot_view_cache_skipped_total', 'counter', lambda: [({}, view_cache.skipped)])
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args): pass
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_response(404); self.send_header('Content-Length', '0'); self.end_headers(); return
+        body = metrics.render().encode()
+        self.send_response(200); self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body))); self.end_headers(); self.wfile.write(body)
+
+def start_metrics_server():
+    if not metrics.enabled: return None
+    register_metric_collectors()
+    try: server = ThreadingHTTPServer((METRICS_HOST, METRICS_PORT), MetricsRequestHandler)
+    except OSError as e: print(f"Не удалось запустить сервер метрик на {METRICS_HOST}:{METRICS_PORT}: {e}"); return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    print(f"Метрики доступны на http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return server
+
+abot = None
+aiohttp_session = None
+async_geolocator = None
+
+async def fetch_weather_by_coords_async(latitude, longitude):
+    if not GISMETEO_TOKEN: return None, "Токен API погоды не настроен."
+    import aiohttp
+    headers = {'X-Gismeteo-Token': GISMETEO_TOKEN, 'Accept-Encoding': 'gzip'}
+    params = {'latitude': str(latitude), 'longitude': str(longitude), 'lang': 'ru'}
+    url = GISMETEO_API_WEATHER_CURRENT
+    for attempt in range(HTTP_RETRIES + 1):
+        started = time.perf_counter()
+        try:
+            async with aiohttp_session.get(url, headers=headers, params=params, timeout=aiohttp.ClientTimeout(total=HTTP_READ_TIMEOUT, sock_connect=HTTP_CONNECT_TIMEOUT)) as response:
+                observe_upstream('gismeteo', response.status, started)
+                if response.status in (500, 502, 503, 504) and attempt < HTTP_RETRIES:
+                    await asyncio.sleep(backoff_delay(attempt)); continue
+                if response.status >= 400:
+                    try: error_data = await response.json(content_type=None)
+                    except Exception: error_data = None
+                    return gismeteo_http_error(response.status, error_data)
+                return parse_gismeteo_response(await response.json(content_type=None))
+        except asyncio.TimeoutError as e:
+            observe_upstream('gismeteo', 'timeout', started)
+            if isinstance(e, getattr(aiohttp, 'ConnectionTimeoutError', ())) and attempt < HTTP_RETRIES: await asyncio.sleep(backoff_delay(attempt)); continue
+            print(f"Gismeteo не ответил за {HTTP_READ_TIMEOUT:g} с: {e!r}"); return None, "Сервис погоды не ответил вовремя."
+        except aiohttp.ClientError as e:
+            observe_upstream('gismeteo', 'error', started)
+            if attempt < HTTP_RETRIES: await asyncio.sleep(backoff_delay(attempt)); continue
+            print(f"Сетевая ошибка запроса Gismeteo: {e}"); return None, f"Сетевая ошибка: {e}"
+        except Exception as e: print(f"Ошибка в fetch_weather_by_coords_async: {e}"); return None, "Внутренняя ошибка получения погоды."
+
+async def fetch_weather_shared_async(latitude, longitude):
+    cache = get_shared_cache(); key = f"{latitude},{longitude}"
+    if cache is not None:
+        shared = cache.get('weather', key)
+        if shared is not None: return shared[1], None
+    weather_data, error_msg = await fetch_weather_by_coords_async(latitude, longitude)
+    if cache is not None and error_msg is None: cache.put('weather', key, weather_data, time.time() + WEATHER_CACHE_TTL)
+    return weather_data, error_msg
+
+async def get_weather_by_coords_async(latitude, longitude):
+    return await weather_cache.get_async(latitude, longitude, fetch_weather_shared_async)
+
+async def get_coordinates_by_city_name_async(city_name):
+    cached = await asyncio.to_thread(get_cached_coordinates, city_name)
+    if cached is not None: return cached
+    cache_key = normalize_city_name(city_name)
+    future = geocode_async_inflight.get(cache_key)
+    if future is not None: return await asyncio.shield(future)
+    future = geocode_async_inflight[cache_key] = asyncio.get_running_loop().create_future()
+    result = (None, None, "Внутренняя ошибка поиска координат.")
+    try: result = await asyncio.to_thread(get_cached_coordinates, city_name) or await geocode_city_name_async(city_name)
+    finally:
+        del geocode_async_inflight[cache_key]; future.set_result(result)
+    return result
+
+async def geocode_city_name_async(city_name):
+    from geopy.exc import GeocoderTimedOut, GeocoderServiceError
+    started = time.perf_counter()
+    try: location = await async_geolocator.geocode(city_name, language='ru', timeout=HTTP_READ_TIMEOUT)
+    except GeocoderTimedOut: observe_upstream('nominatim', 'timeout', started); return None, None, "Сервис геокодинга не ответил вовремя."
+    except GeocoderServiceError as e: observe_upstream('nominatim', 'error', started); return None, None, f"Ошибка сервиса геокодинга: {e}"
+    except Exception as e:
+        observe_upstream('nominatim', 'error', started)
+        print(f"Неожиданная ошибка геокодинга '{city_name}': {e}"); return None, None, "Внутренняя ошибка поиска координат."
+    observe_upstream('nominatim', 'ok' if location else 'not_found', started)
+    return await asyncio.to_thread(remember_coordinates, city_name, location)
+
+@observe_handler('start')
+async def send_welcome_or_menu_async(message):
+    if message.text.startswith('/start'):
+        await aoutbox.send_message(message.chat.id, build_welcome_text(message.from_user.first_name), reply_markup=create_main_keyboard(), parse_mode='Markdown')
+    else:
+        await aoutbox.send_message(message.chat.id, "📌 Главное меню:", reply_markup=create_main_keyboard())
+
+@observe_handler('help')
+async def send_structured_help_async(message):
     try:
-        bot.infinity_polling(timeout=20, long_polling_timeout=10)
+        await aoutbox.reply_to(message, build_help_text(), parse_mode='Markdown')
+    except Exception as e: report_error('help', f"Ошибка /help: {e}")
+
+@observe_handler('tasks_button')
+async def handle_tasks_button_async(message):
+    await aoutbox.send_message(message.chat.id, TASKS_INFO_TEXT, parse_mode='Markdown')
+
+@observe_handler('weather_button')
+async def handle_weather_button_async(message):
+    await aoutbox.send_message(message.chat.id, CITY_PROMPT, reply_markup=types.ForceReply(selective=True))
+
+@observe_handler('add')
+async def handle_add_task_async(message):
+    try:
+        task_text = command_argument(message)
+        if task_text is None:
+            await aoutbox.reply_to(message, ADD_TASK_PROMPT, reply_markup=types.ForceReply(selective=True))
+            return
+        await aoutbox.reply_to(message, await asyncio.to_thread(add_tasks_from_text, message.chat.id, task_text), parse_mode='Markdown')
+    except Exception as e:
+        report_error('add', f"Ошибка /add: {e}")
+        await aoutbox.reply_to(message, "❌ Ошибка при добавлении задачи.")
+
+async def send_task_view_async(message, context, error_text):
+    try:
+        message_text, markup = await asyncio.to_thread(render_task_view, context, message.chat.id, 1)
+        sent = await aoutbox.send_message(message.chat.id, message_text, reply_markup=markup, parse_mode='Markdown')
+        view_cache.remember(message.chat.id, sent.message_id, view_cache.fingerprint(message_text, markup))
+    except Exception as e: report_error(context, f"Ошибка /{context}: {e}"); await aoutbox.reply_to(message, error_text)
+
+@observe_handler('list')
+async def handle_list_tasks_async(message):
+    await send_task_view_async(message, "list", "❌ Не удалось показать список.")
+
+@observe_handler('last')
+async def handle_last_tasks_async(message):
+    await send_task_view_async(message, "last10", "❌ Не удалось показать последние задачи.")
+
+@observe_handler('completed')
+async def handle_completed_tasks_async(message):
+    await send_task_view_async(message, "completed", "❌ Не удалось показать выполненные задачи.")
+
+@observe_handler('weather')
+async def handle_weather_command_async(message):
+    processing_msg = None
+    try:
+        city_name_query = command_argument(message)
+        if city_name_query is None:
+            await aoutbox.reply_to(message, CITY_PROMPT, reply_markup=types.ForceReply(selective=True))
+            return
+        processing_msg = await aoutbox.reply_to(message, f"🌍 Ищу '{escape(city_name_query)}'...")
+        latitude, longitude, full_address = await get_coordinates_by_city_name_async(city_name_query)
+        if full_address and not latitude:
+            await aoutbox.edit_message_text(chat_id=message.chat.id, message_id=processing_msg.message_id, text=f"⚠️ {full_address}")
+            return
+        location_display_name = full_address if full_address else city_name_query
+        await asyncio.gather(
+            aoutbox.edit_message_text(chat_id=message.chat.id, message_id=processing_msg.message_id, text=f"📍 Найдены координаты. Запрашиваю погоду..."),
+            aoutbox.send_chat_action(message.chat.id, 'typing'))
+        weather_data, error_msg = await get_weather_by_coords_async(latitude, longitude)
+        if error_msg:
+            await aoutbox.edit_message_text(chat_id=message.chat.id, message_id=processing_msg.message_id, text=f"⚠️ Ошибка погоды: {error_msg}")
+            return
+        weather_message = format_weather_message(weather_data, location_display_name)
+        await aoutbox.edit_message_text(chat_id=message.chat.id, message_id=processing_msg.message_id, text=weather_message, parse_mode='Markdown')
+    except Exception as e:
+        report_error('weather', f"Критич. ошибка handle_weather_command_async: {e}")
+        try:
+            if processing_msg: await aoutbox.edit_message_text(chat_id=message.chat.id, message_id=processing_msg.message_id, text="❌ Внутр. ошибка погоды.")
+            else: await aoutbox.reply_to(message, "❌ Внутр. ошибка погоды.")
+        except Exception as inner_e: print(f"Не удалось отправить сообщение об ошибке погоды: {inner_e}")
+
+@observe_handler('task_reply')
+async def handle_task_text_reply_async(message):
+    task_text = message.text.strip()
+    if not task_text:
+        await aoutbox.reply_to(message, "Вы отправили пустой текст. Задача не добавлена. Попробуйте /add <текст>.")
+        return
+    message.text = f"/add {task_text}"
+    await handle_add_task_async(message)
+
+@observe_handler('city_reply')
+async def handle_city_name_reply_async(message):
+    city_name = message.text.strip()
+    if not city_name:
+        await aoutbox.reply_to(message, "Вы отправили пустое название. Попробуйте /weather <город>.")
+        return
+    message.text = f"/weather {city_name}"
+    await handle_weather_command_async(message)
+
+@observe_handler('callback')
+async def handle_callback_query_async(call):
+    chat_id = call.message.chat.id; message_id = call.message.message_id; callback_data = call.data
+    try:
+        answer, view = await asyncio.to_thread(process_callback_data, chat_id, callback_data)
+        await aoutbox.answer_callback_query(call.id, **answer)
+        if view: await update_task_view_async(view[0], chat_id, message_id, view[1])
+    except Exception as e:
+        report_error('callback', f"Критич. ошибка callback: {e}, data: {callback_data}")
+        try: await aoutbox.answer_callback_query(call.id, "Внутр. ошибка", show_alert=True)
+        except Exception: pass
+
+async def update_task_view_async(context, chat_id, message_id, page):
+    try:
+        rendered = await asyncio.to_thread(render_task_view, context, chat_id, page)
+        if rendered is None: return
+        message_text, markup = rendered
+        fingerprint = view_cache.fingerprint(message_text, markup)
+        if view_cache.is_unchanged(chat_id, message_id, fingerprint): return
+        view_cache.remember(chat_id, message_id, fingerprint)
+    except Exception as e: print(f"Ошибка обновления ({context}): {e}"); return
+    try: await aoutbox.edit_message_text(chat_id=chat_id, message_id=message_id, text=message_text, reply_markup=markup, parse_mode='Markdown')
+    except Exception as e: view_cache.forget(chat_id, message_id); print(f"Ошибка обновления ({context}): {e}")
+
+def register_async_handlers(async_bot):
+    async_bot.register_message_handler(send_welcome_or_menu_async, commands=['start', 'menu'])
+    async_bot.register_message_handler(send_structured_help_async, commands=['help'])
+    async_bot.register_message_handler(handle_tasks_button_async, func=lambda message: message.text == "📋 Задачи")
+    async_bot.register_message_handler(handle_weather_button_async, func=lambda message: message.text == "☀️ Погода")
+    async_bot.register_message_handler(send_structured_help_async, func=lambda message: message.text == "ℹ️ Помощь")
+    async_bot.register_message_handler(handle_add_task_async, commands=['add'])
+    async_bot.register_message_handler(handle_list_tasks_async, commands=['list'])
+    async_bot.register_message_handler(handle_last_tasks_async, commands=['last', 'last10'])
+    async_bot.register_message_handler(handle_completed_tasks_async, commands=['completed'])
+    async_bot.register_message_handler(handle_weather_command_async, commands=['weather'])
+    async_bot.register_message_handler(handle_task_text_reply_async, func=is_task_text_reply)
+    async_bot.register_message_handler(handle_city_name_reply_async, func=is_city_name_reply)
+    async_bot.register_callback_query_handler(handle_callback_query_async, func=lambda call: True)
+
+async def run_async_bot():
+    global abot, aoutbox, aiohttp_session, async_geolocator
+    import aiohttp
+    from telebot import asyncio_helper
+    from telebot.async_telebot import AsyncTeleBot
+    from geopy.adapters import AioHTTPAdapter
+    from geopy.geocoders import Nominatim
+    asyncio_helper.REQUEST_LIMIT = ASYNC_REQUEST_LIMIT
+    if TELEGRAM_API_URL: asyncio_helper.API_URL = TELEGRAM_API_URL
+    aiohttp_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=HTTP_POOL_SIZE, keepalive_timeout=60))
+    async_geolocator = Nominatim(user_agent="my_telegram_task_weather_bot/1.0", domain=NOMINATIM_DOMAIN, scheme=NOMINATIM_SCHEME, adapter_factory=AioHTTPAdapter)
+    abot = AsyncTeleBot(API_TOKEN); aoutbox = AsyncTelegramDispatcher(abot)
+    register_async_handlers(abot)
+    print(f"Запуск asyncio polling (до {ASYNC_REQUEST_LIMIT} одновременных запросов к Telegram)...")
+    try:
+        report_startup()
+        await abot.infinity_polling(timeout=20, request_timeout=30)
+    finally:
+        await aoutbox.drain()
+        await aiohttp_session.close()
+        await asyncio_helper.session_manager.session.close()
+
+mark_startup('import', startup_started)
+
+if __name__ == '__main__':
+    if '--migrate-json-to-sqlite' in sys.argv:
+        migrate_json_to_sqlite()
+        sys.exit(0)
+    check_tokens()
+    configure_telegram_api()
+    router = None
+    try:
+        start_metrics_server()
+        rebalance_shards(BOT_SHARDS)
+        if BOT_SHARDS > 1: router = start_shard_router()
+        else: start_background_startup()
+        print("Бот запускается...")
+        if BOT_RUNTIME == 'asyncio' and router is None:
+            asyncio.run(run_async_bot())
+        elif BOT_INGRESS == 'webhook':
+            try: run_webhook()
+            except (OSError, ValueError, telebot.apihelper.ApiException) as e:
+                print(f"Webhook недоступен ({e}), переключаюсь на polling.")
+                bot.threaded = True; run_polling()
+        else: run_polling()
     except Exception as e:
         print(f"Критическая ошибка polling: {e}")
         time.sleep(15)
     finally:
         print("Сохранение данных перед остановкой...")
-        save_data(all_user_data)
-        print("Бот остановлен.")
\ No newline at end of file
+        if router is not None: router.stop()
+        outbox.drain()
+        if storage_ready.is_set(): storage.close()
+        flush_geocode_cache()
+        print("Бот остановлен.")